@@ -0,0 +1,205 @@
+#! /usr/bin/env python
+
+import struct
+from array import array
+from strpatchwork import get_bytes
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# array type code of native 32 bit words
+dword_code = [t for t in 'IL' if array(t).itemsize == 4][0]
+
+
+def dword_sum(s, start=0, stop=None):
+    """Sum of the native 32 bit words of s[@start:@stop], whose length is a
+    multiple of 4; @s is a str or a buffer object"""
+    if stop is None:
+        stop = len(s)
+    if stop <= start:
+        return 0
+    if numpy is not None:
+        words = numpy.frombuffer(s, numpy.uint32, (stop - start) / 4, start)
+        return int(words.sum(dtype=numpy.uint64))
+    return sum(array(dword_code, get_bytes(s, start, stop)))
+
+
+def fold(s):
+    """Fold the sum @s in 16 bits"""
+    while s > 0xFFFFFFFF:
+        s = (s >> 32) + (s & 0xFFFFFFFF)
+    while s > 0xFFFF:
+        s = (s & 0xFFFF) + ((s >> 16) & 0xFFFF)
+    return s
+
+
+def read_range(s, start, stop):
+    """Return s[@start:@stop] as a str; @s is a str, a buffer object or a
+    LayeredView"""
+    if hasattr(s, 'read'):
+        return s.read(start, stop)
+    return get_bytes(s, start, stop)
+
+
+class Checksum(object):
+    """
+    PE checksum of the successive builds of an image, kept as the sums of
+    its 32 bit words by chunks of @chunk bytes: a build only sums again
+    the chunks hit by the ranges changed since the previous one.
+    """
+
+    def __init__(self, chunk=0x100000):
+        self.chunk = chunk
+        self.length = None
+        # the 32 bit words summed are image[shift:stop]; an odd trailing
+        # byte and, if the length is not a multiple of 4, the first 16 bit
+        # word are added apart
+        self.shift = self.stop = 0
+        # sum of each chunk, None when it has to be summed again
+        self.sums = []
+
+    def chunk_range(self, i):
+        """Return the (start, stop) range of the @i-th chunk"""
+        start = self.shift + i * self.chunk
+        return start, min(start + self.chunk, self.stop)
+
+    def reset(self, length, changes=None):
+        """
+        Start a build of @length bytes
+        @changes: (start, stop) ranges of the image which may differ from
+        the previous build, None if unknown
+        """
+        stop = length & ~1
+        shift = stop % 4
+        count = (stop - shift + self.chunk - 1) / self.chunk
+        if self.length is None or changes is None or shift != self.shift:
+            self.sums = [None] * count
+        else:
+            old_stop = self.stop
+            sums = self.sums[:count] + [None] * (count - len(self.sums))
+            # the chunk holding the former end changes with the length
+            for i in xrange(count):
+                start = shift + i * self.chunk
+                end = start + self.chunk
+                if min(end, old_stop) != min(end, stop):
+                    sums[i] = None
+            for start, end in changes:
+                first = max(start - shift, 0) / self.chunk
+                last = min((end - shift - 1) / self.chunk, count - 1)
+                for i in xrange(first, last + 1):
+                    sums[i] = None
+            self.sums = sums
+        self.length, self.shift, self.stop = length, shift, stop
+
+    def pieces(self):
+        """Yield the (start, stop) ranges covering the image, the chunks
+        being whole ones, to be read in order and passed to feed()"""
+        if self.shift:
+            yield 0, self.shift
+        for i in xrange(len(self.sums)):
+            yield self.chunk_range(i)
+        if self.stop < self.length:
+            yield self.stop, self.length
+
+    def feed(self, start, data):
+        """Keep the sum of the range of pieces() starting at @start, whose
+        content is @data, if it is an unknown chunk"""
+        if not self.shift <= start < self.stop:
+            return
+        i = (start - self.shift) / self.chunk
+        if self.sums[i] is None:
+            self.sums[i] = dword_sum(data)
+
+    def update(self, s, olds=0):
+        """
+        Return the checksum of the image @s (str, buffer object or
+        LayeredView), summing the chunks not known yet
+        @olds: checksum held by the header
+        """
+        if len(s) != self.length:
+            raise ValueError('got %d bytes for %d' % (len(s), self.length))
+        for i, value in enumerate(self.sums):
+            if value is None:
+                start, stop = self.chunk_range(i)
+                if hasattr(s, 'read'):
+                    self.sums[i] = dword_sum(s.read(start, stop))
+                else:
+                    self.sums[i] = dword_sum(s, start, stop)
+        total = sum(self.sums)
+        if self.shift:
+            total += struct.unpack('H', read_range(s, 0, 2))[0]
+        total = fold(total - olds)
+        if self.length % 2:
+            total += ord(read_range(s, self.length - 1, self.length))
+        return total + self.length
+
+
+def pe_checksum(s, olds=0, chunk=0x100000):
+    """Return the checksum of the PE image @s (str, buffer object or
+    LayeredView), whose header holds the checksum @olds; summed by chunks
+    of @chunk bytes"""
+    crc = Checksum(chunk)
+    crc.reset(len(s))
+    return crc.update(s, olds)
+
+if __name__ == "__main__":
+    import random
+
+    def reference(c, olds):
+        # the former PE.patch_crc arithmetic
+        s = 0L
+        data = c[:]
+        if len(c) % 2:
+            end = ord(data[-1])
+            data = data[:-1]
+        if (len(c) & ~0x1) % 4:
+            s += struct.unpack('H', data[:2])[0]
+            data = data[2:]
+        s = sum(array(dword_code, data), s) - olds
+        while s > 0xFFFFFFFF:
+            s = (s >> 32) + (s & 0xFFFFFFFF)
+        while s > 0xFFFF:
+            s = (s & 0xFFFF) + ((s >> 16) & 0xFFFF)
+        if len(c) % 2:
+            s += end
+        return s + len(c)
+
+    rand = random.Random(0)
+    for length in range(0, 16) + [4099, 4100, 4101, 4102, 65537]:
+        data = "".join(chr(rand.randrange(256)) for _ in xrange(length))
+        olds = rand.randrange(0x10000)
+        expected = reference(data, olds)
+        assert pe_checksum(data, olds) == expected
+        assert pe_checksum(data, olds, chunk=8) == expected
+        assert pe_checksum(buffer(data), olds) == expected
+        # streamed by pieces, as PE.write does
+        crc = Checksum(chunk=8)
+        crc.reset(length)
+        for start, stop in crc.pieces():
+            crc.feed(start, data[start:stop])
+        assert None not in crc.sums
+        assert crc.update(data, olds) == expected
+    # incremental updates: only the changed chunks are summed again
+    data = bytearray(rand.getrandbits(8) for _ in xrange(10001))
+    crc = Checksum(chunk=64)
+    crc.reset(len(data))
+    crc.update(str(data))
+    reused = 0
+    for _ in xrange(200):
+        start = rand.randrange(len(data) + 100)
+        size = rand.randrange(1, 40)
+        if start > len(data):
+            data.extend(rand.getrandbits(8) for _ in xrange(size))
+        elif rand.randrange(4) == 0:
+            del data[start:start + size]
+            size = len(data)
+        else:
+            data[start:start + size] = bytearray(rand.getrandbits(8)
+                                                 for _ in xrange(size))
+        crc.reset(len(data), [(start, start + size)])
+        reused += len(crc.sums) - crc.sums.count(None)
+        olds = rand.randrange(0x10000)
+        assert crc.update(str(data), olds) == reference(str(data), olds)
+    assert reused > 0
+    print "ok"
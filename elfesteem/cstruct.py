@@ -1,6 +1,7 @@
 #! /usr/bin/env python
 
 import struct
+from strpatchwork import unpack_from, get_bytes
 
 type_size = {}
 size2type = {}
@@ -15,6 +16,17 @@ type_size['u32'] = size2type[32]
 type_size['u64'] = size2type[64]
 
 
+packstructs = {}
+
+
+def get_struct(fmt):
+    st = packstructs.get(fmt)
+    if st is None:
+        st = struct.Struct(fmt)
+        packstructs[fmt] = st
+    return st
+
+
 def fix_size(fields, wsize):
     out = []
     for name, v in fields:
@@ -68,14 +80,21 @@ class CStruct(object):
             self.__dict__.update(kargs)
         else:
             s = ""
+            off = 0
             if args:
                 s = args[0]
-            s += "\x00" * self._size
-            s = s[:self._size]
-            self._unpack(s)
-
-    def _unpack(self, s):
-        disas = struct.unpack(self._packstring, s)
+            if len(args) > 1:
+                off = args[1]
+            self._unpack(s, off)
+
+    def _unpack(self, s, off=0):
+        """Unpack the fields from @s (str, buffer object or StrPatchwork) at
+        @off; missing data is read as zeros"""
+        if len(s) < off + self._size:
+            s = get_bytes(s, off, off + self._size)
+            s += "\x00" * (self._size - len(s))
+            off = 0
+        disas = unpack_from(get_struct(self._packstring), s, off)
         for n, v in zip(self._names, disas):
             setattr(self, n, v)
 
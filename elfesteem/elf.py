@@ -218,6 +218,13 @@ EM_XTENSA =      94              # Tensilica Xtensa Architecture
 
 EM_ALPHA =       0x9026
 
+# Special section indices.
+
+SHN_UNDEF =      0               # Undefined section
+SHN_ABS =        0xfff1          # Associated symbol is absolute
+SHN_COMMON =     0xfff2          # Associated symbol is common
+SHN_XINDEX =     0xffff          # Index is in extra table.
+
 # Legal values for sh_type (section type).
 
 SHT_NULL =          0             # Section header table entry unused
@@ -239,6 +246,7 @@ SHT_GROUP =         17            # Section group
 SHT_SYMTAB_SHNDX =  18            # Extended section indeces
 SHT_NUM =           19            # Number of defined types.
 SHT_LOOS =          0x60000000L   # Start OS-specific
+SHT_GNU_HASH =      0x6ffffff6L   # GNU-style hash table.
 SHT_GNU_LIBLIST =   0x6ffffff7L   # Prelink library list
 SHT_CHECKSUM =      0x6ffffff8L   # Checksum for DSO content.
 SHT_LOSUNW =        0x6ffffffaL   # Sun-specific low bound.
@@ -422,6 +430,7 @@ DT_VALNUM = 12
 # If any adjustment is made to the ELF object after it has been
 # built these entries will need to be adjusted.
 DT_ADDRRNGLO    = 0x6ffffe00
+DT_GNU_HASH     = 0x6ffffef5      # GNU-style hash table.
 DT_GNU_CONFLICT = 0x6ffffef8      # Start of conflict section
 DT_GNU_LIBLIST  = 0x6ffffef9      # Library list
 DT_CONFIG       = 0x6ffffefa      # Configuration information.
@@ -448,6 +457,10 @@ DT_VERNEED      = 0x6ffffffe      # Address of table with needed versions
 DT_VERNEEDNUM   = 0x6fffffff      # Number of needed versions
 DT_VERSIONTAGNUM = 16
 
+# Symbol version indexes in the SHT_GNU_versym section.
+VER_NDX_LOCAL   = 0               # Symbol is local.
+VER_NDX_GLOBAL  = 1               # Symbol is global.
+
 # Sun added these machine-independent extensions in the "processor-specific"
 # range.  Be compatible.
 DT_AUXILIARY    = 0x7ffffffd      # Shared object to load before self
@@ -1,10 +1,15 @@
 #! /usr/bin/env python
 
 import struct
+from bisect import bisect_left, bisect_right
 
 import cstruct
 import elf
-from strpatchwork import StrPatchwork
+import new_cstruct
+from intervals import AddrIndex, SpanIndex
+from scanner import Scanner, contiguous_runs
+from strpatchwork import StrPatchwork, get_bytes, get_view, unpack_from, \
+    find_bytes, read_file
 import logging
 
 log = logging.getLogger("elfparse")
@@ -12,6 +17,10 @@ console_handler = logging.StreamHandler()
 console_handler.setFormatter(logging.Formatter("%(levelname)-5s: %(message)s"))
 log.addHandler(console_handler)
 log.setLevel(logging.WARN)
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class test(type):
@@ -77,7 +86,7 @@ class WRel32(StructWrapper):
     wrapped._fields.append(("type", "u08"))
 
     def get_sym(self):
-        return self.parent.linksection.symtab[self.cstr.info >> 8].name
+        return self.parent.linksection.symbol_name(self.cstr.info >> 8)
 
     def get_type(self):
         return self.cstr.info & 0xff
@@ -89,7 +98,7 @@ class WRel64(StructWrapper):
     wrapped._fields.append(("type", "u32"))
 
     def get_sym(self):
-        return self.parent.linksection.symtab[self.cstr.info >> 32].name
+        return self.parent.linksection.symbol_name(self.cstr.info >> 32)
 
     def get_type(self):
         return self.cstr.info & 0xffffffff
@@ -101,7 +110,7 @@ class WRela32(WRel32):
     wrapped._fields.append(("type", "u08"))
 
     def get_sym(self):
-        return self.parent.linksection.symtab[self.cstr.info >> 8].name
+        return self.parent.linksection.symbol_name(self.cstr.info >> 8)
 
     def get_type(self):
         return self.cstr.info & 0xff
@@ -113,7 +122,7 @@ class WRela64(WRel64):
     wrapped._fields.append(("type", "u32"))
 
     def get_sym(self):
-        return self.parent.linksection.symtab[self.cstr.info >> 32].name
+        return self.parent.linksection.symbol_name(self.cstr.info >> 32)
 
     def get_type(self):
         return self.cstr.info & 0xffffffff
@@ -246,9 +255,222 @@ class ProgBits(Section):
     sht = elf.SHT_PROGBITS
 
 
+def elf_hash(name):
+    """SysV hash of the symbol name @name"""
+    h = 0
+    for c in name:
+        h = ((h << 4) + ord(c)) & 0xffffffff
+        g = h & 0xf0000000
+        h ^= g >> 24
+        h &= ~g
+    return h
+
+
+def gnu_hash(name):
+    """GNU hash of the symbol name @name"""
+    h = 5381
+    for c in name:
+        h = (h * 33 + ord(c)) & 0xffffffff
+    return h
+
+
+# bucket counts of the hash tables, as chosen by the GNU linker
+hash_bucket_counts = [1, 3, 17, 37, 67, 97, 131, 197, 263, 521, 1031, 2053,
+                      4099, 8209, 16411, 32771, 65537, 131101, 262147]
+
+
+def hash_bucket_count(nsyms):
+    """Number of buckets of a hash table of @nsyms symbols"""
+    best = 1
+    for i, count in enumerate(hash_bucket_counts):
+        best = count
+        if (i + 1 == len(hash_bucket_counts) or
+                nsyms < hash_bucket_counts[i + 1]):
+            break
+    return best
+
+
 class HashSection(Section):
+    """
+    SysV hash table of the linked symbol table: nbucket, nchain, the
+    buckets then the chains. Lookups only decode the symbols of one chain.
+    """
     sht = elf.SHT_HASH
 
+    def word_format(self, wsize=32):
+        if self.sex == 1:
+            sex = '<'
+        else:
+            sex = '>'
+        return sex + {32: 'I', 64: 'Q'}[wsize]
+
+    def unpack_words(self, of, count, wsize=32):
+        fmt = self.word_format(wsize)
+        st = struct.Struct(fmt[0] + '%d' % count + fmt[1:])
+        if count <= 0 or of + st.size > len(self.content):
+            return []
+        return list(unpack_from(st, self.content, of))
+
+    def pack_words(self, words, wsize=32):
+        fmt = self.word_format(wsize)
+        return struct.pack(fmt[0] + '%d' % len(words) + fmt[1:], *words)
+
+    def parse_content(self, sex, size):
+        self.sex, self.size = sex, size
+        # 64 bit words on a few 64 bit architectures
+        wsize = 8 * (self.sh.entsize or 4)
+        header = self.unpack_words(0, 2, wsize)
+        if not header:
+            self.buckets, self.chains = [], []
+            return
+        nbucket, nchain = header
+        self.buckets = self.unpack_words(2 * wsize / 8, nbucket, wsize)
+        self.chains = self.unpack_words((2 + nbucket) * wsize / 8, nchain,
+                                        wsize)
+
+    def symbol_index(self, name):
+        """Return the index of the symbol @name defined in the linked
+        table, None if there is none"""
+        if not self.buckets:
+            return None
+        symtab = self.linksection
+        i = self.buckets[elf_hash(name) % len(self.buckets)]
+        # bounded, in case of a looping chain
+        for _ in xrange(len(self.chains)):
+            if not 0 < i < min(len(self.chains), len(symtab)):
+                break
+            if (symtab.symbol_name(i) == name and
+                    symtab.table.get(i, 'shndx') != elf.SHN_UNDEF):
+                return i
+            i = self.chains[i]
+        return None
+
+    def lookup(self, name):
+        """Return the symbol @name as the dynamic loader finds it, None if
+        there is none"""
+        i = self.symbol_index(name)
+        if i is None:
+            return None
+        return self.linksection[i]
+
+    def rebuild(self):
+        """Regenerate the table from the linked symbol table; returns the
+        new order of the symbols (unchanged here, see GNUHashSection).
+        The number of buckets is kept while the symbols fit in the former
+        chains, which are padded, so that the table keeps its size"""
+        names = self.linksection.get_names()
+        if self.buckets and len(names) <= len(self.chains):
+            nbucket = len(self.buckets)
+            padding = [0] * (len(self.chains) - len(names))
+        else:
+            nbucket = hash_bucket_count(len(names))
+            padding = []
+        buckets = [0] * nbucket
+        chains = [0] * len(names)
+        for i in xrange(len(names) - 1, 0, -1):
+            h = elf_hash(names[i]) % nbucket
+            chains[i] = buckets[h]
+            buckets[h] = i
+        wsize = 8 * (self.sh.entsize or 4)
+        self.content = self.pack_words([nbucket, len(names)] + buckets +
+                                       chains + padding, wsize)
+        return range(len(names))
+
+
+class GNUHashSection(HashSection):
+    """
+    GNU hash table of the linked symbol table: nbuckets, symoffset,
+    bloom_size, bloom_shift, the bloom filter words, the buckets then the
+    hash values of the symbols from symoffset on, grouped by bucket. Most
+    missing names are rejected by the bloom filter alone.
+    """
+    sht = elf.SHT_GNU_HASH
+
+    def parse_content(self, sex, size):
+        self.sex, self.size = sex, size
+        header = self.unpack_words(0, 4)
+        if not header:
+            self.symoffset, self.bloom_shift = 1, 0
+            self.bloom, self.buckets, self.chains = [], [], []
+            return
+        nbuckets, self.symoffset, bloom_size, self.bloom_shift = header
+        self.bloom = self.unpack_words(16, bloom_size, size)
+        of = 16 + bloom_size * size / 8
+        self.buckets = self.unpack_words(of, nbuckets)
+        of += nbuckets * 4
+        self.chains = self.unpack_words(of, (len(self.content) - of) / 4)
+
+    def symbol_index(self, name):
+        if not self.buckets or not self.bloom:
+            return None
+        h = gnu_hash(name)
+        bits = self.size
+        word = self.bloom[(h / bits) % len(self.bloom)]
+        mask = (1 << (h % bits)) | (1 << ((h >> self.bloom_shift) % bits))
+        if word & mask != mask:
+            return None
+        symtab = self.linksection
+        i = self.buckets[h % len(self.buckets)]
+        if i < self.symoffset:
+            return None
+        while i - self.symoffset < len(self.chains) and i < len(symtab):
+            h2 = self.chains[i - self.symoffset]
+            if ((h ^ h2) | 1 == 1 and symtab.symbol_name(i) == name and
+                    symtab.table.get(i, 'shndx') != elf.SHN_UNDEF):
+                return i
+            if h2 & 1:
+                break
+            i += 1
+        return None
+
+    def rebuild(self):
+        """Regenerate the table from the linked symbol table; the symbols
+        from symoffset on are reordered by bucket, as the format requires
+        (see SymTable.reorder, which rebuilds the other hash tables).
+        The number of buckets and the bloom filter are kept while the
+        symbols fit in the former chains, which are padded, so that the
+        table keeps its size. Returns the new order of the symbols"""
+        symtab = self.linksection
+        names = symtab.get_names()
+        symoffset = min(self.symoffset, len(names))
+        hashes = [gnu_hash(n) for n in names[symoffset:]]
+        bits = self.size
+        shift1 = {32: 5, 64: 6}[bits]
+        if self.buckets and self.bloom and len(hashes) <= len(self.chains):
+            nbuckets = len(self.buckets)
+            bloom_size, shift2 = len(self.bloom), self.bloom_shift
+            padding = [0] * (len(self.chains) - len(hashes))
+        else:
+            nbuckets = hash_bucket_count(len(hashes))
+            # about 2 to 4 bits per symbol in the bloom filter, as the GNU
+            # linker does
+            shift2 = max(len(hashes).bit_length() + 1, shift1)
+            bloom_size = 1 << (shift2 - shift1)
+            padding = []
+        order = range(symoffset) + sorted(
+            xrange(symoffset, len(names)),
+            key=lambda i: hashes[i - symoffset] % nbuckets)
+        if order != range(len(names)):
+            symtab.reorder(order, keep=[self])
+            hashes = [hashes[i - symoffset] for i in order[symoffset:]]
+        bloom = [0] * bloom_size
+        buckets = [0] * nbuckets
+        chains = [h & ~1 for h in hashes]
+        for i, h in enumerate(hashes):
+            bloom[(h / bits) % len(bloom)] |= (1 << (h % bits)) | (
+                1 << ((h >> shift2) % bits))
+            b = h % nbuckets
+            if not buckets[b]:
+                buckets[b] = symoffset + i
+            if i + 1 == len(hashes) or hashes[i + 1] % nbuckets != b:
+                chains[i] |= 1
+        self.content = (self.pack_words([nbuckets, symoffset, len(bloom),
+                                         shift2]) +
+                        self.pack_words(bloom, bits) +
+                        self.pack_words(buckets) +
+                        self.pack_words(chains + padding))
+        return order
+
 
 class NoBitsSection(Section):
     sht = elf.SHT_NOBITS
@@ -294,6 +516,9 @@ class CheckSumSection(Section):
     sht = elf.SHT_CHECKSUM
 
 
+note_hdr = struct.Struct("III")
+
+
 class NoteSection(Section):
     sht = elf.SHT_NOTE
 
@@ -301,12 +526,13 @@ class NoteSection(Section):
         self.sex, self.size = sex, size
         c = self.content
         self.notes = []
+        of = 0
         # XXX: c may not be aligned?
-        while len(c) > 12:
-            namesz, descsz, typ = struct.unpack("III", c[:12])
-            name = c[12:12 + namesz]
-            desc = c[12 + namesz:12 + namesz + descsz]
-            c = c[12 + namesz + descsz:]
+        while len(c) - of > 12:
+            namesz, descsz, typ = unpack_from(note_hdr, c, of)
+            name = c[of + 12:of + 12 + namesz]
+            desc = c[of + 12 + namesz:of + 12 + namesz + descsz]
+            of += 12 + namesz + descsz
             self.notes.append((typ, name, desc))
 
 
@@ -321,9 +547,8 @@ class Dynamic(Section):
         sz = self.sh.entsize
         idx = 0
         while len(c) > sz*idx:
-            s = c[sz*idx:sz*(idx+1)]
+            dyn = WDynamic(self, sex, size, c, sz*idx)
             idx += 1
-            dyn = WDynamic(self, sex, size, s)
             self.dyntab.append(dyn)
             if type(dyn.name) is str:
                 self.dynamic[dyn.name] = dyn
@@ -335,79 +560,485 @@ class Dynamic(Section):
 
 
 class StrTable(Section):
+    """
+    String table. Names are cached by offset once read. Names are added
+    through a name -> offset dict and a sorted index of the reversed
+    names, so that a name which is the tail of another one shares its
+    bytes; new names are appended without rewriting the table.
+    The caches are dropped when the content is written in place (e.g.
+    strtab.content[ofs] = 'XYZ'), which StrPatchwork.writes tells;
+    invalidate() drops them explicitly.
+    """
     sht = elf.SHT_STRTAB
 
     def parse_content(self, sex, size):
         self.sex, self.size = sex, size
-        self.res = {}
         c = self.content
-        q = 0
+        if len(c) and c[len(c) - 1] != "\0":
+            log.warning("Missing trailing 0 for string [%s]" % c)  # XXX
+        self.invalidate()
+
+    def invalidate(self):
+        """Drop the caches of the names, e.g. after the content has been
+        changed through another object"""
+        # content writes the caches are up to date with
+        self._writes = self.content.writes
+        # flat copy of the table
+        self._text = None
+        self._names = {}
+        # name -> offset, and reversed names sorted with the offset of
+        # their trailing 0, built on the first addition
+        self._offsets = None
+        self._tails = None
+        self._tail_ends = None
+        # names cached by the symbol tables using this one
+        for sec in self.parent.shlist:
+            if isinstance(sec, SymTable) and sec.linksection is self:
+                sec.invalidate_names()
+
+    def check_writes(self):
+        """Drop the caches if the content has been written since they were
+        built"""
+        if self._writes != self._content.writes:
+            self.invalidate()
+
+    def get_text(self):
+        """Return the whole table as a str"""
+        self.check_writes()
+        if self._text is None:
+            self._text = str(self.content)
+        return self._text
+
+    def get_res(self):
+        """Return {offset: name} of the names of the table"""
+        text = self.get_text()
+        res = {}
         index = 0
-        l = len(c)
-        while index < l:
-            p = c.find("\0", index)
-            if p < 0:
-                log.warning("Missing trailing 0 for string [%s]" % c)  # XXX
-                p = len(c) - index
-            self.res[index] = c[index:p]
-            # print q, c[:p]
-            index = p + 1
-            # q += p+1
-            # c = c[p+1:]
+        for name in text.split("\0")[:-1]:
+            res[index] = name
+            index += len(name) + 1
+        if index < len(text):
+            res[index] = text[index:]
+        return res
+    res = property(get_res)
 
     def get_name(self, ofs):
-        n = self.content[ofs:self.content.find('\x00', offset=ofs)]
-        return n
+        if self._writes != self._content.writes:
+            self.invalidate()
+        name = self._names.get(ofs)
+        if name is None:
+            text = self.get_text()
+            end = text.find("\0", ofs)
+            if end < 0:
+                end = len(text)
+            name = self._names[ofs] = text[ofs:end]
+        return name
+
+    def get_names(self, offsets):
+        """Return the names at each of @offsets, in one pass"""
+        c = self.get_text()
+        names = []
+        for ofs in offsets:
+            end = c.find('\x00', ofs)
+            if end < 0:
+                end = len(c)
+            names.append(c[ofs:end])
+        return names
+
+    def build_index(self):
+        self.check_writes()
+        if self._offsets is not None:
+            return
+        text = self.get_text()
+        offsets = {}
+        tails = []
+        index = 0
+        # the last piece is not terminated, it cannot be shared
+        for name in text.split("\0")[:-1]:
+            if name not in offsets:
+                offsets[name] = index
+            tails.append((name[::-1], index + len(name)))
+            index += len(name) + 1
+        tails.sort()
+        self._offsets = offsets
+        self._tails = [t[0] for t in tails]
+        self._tail_ends = [t[1] for t in tails]
+
+    def register_name(self, name, ofs):
+        """Record that @name is stored at @ofs"""
+        self._names[ofs] = name
+        if self._offsets is None:
+            return
+        self._offsets.setdefault(name, ofs)
+        key = name[::-1]
+        i = bisect_left(self._tails, key)
+        self._tails.insert(i, key)
+        self._tail_ends.insert(i, ofs + len(name))
+
+    def find_name(self, name):
+        """Return the offset of @name, possibly stored as the tail of a
+        longer name; -1 if the table does not hold it"""
+        self.build_index()
+        ofs = self._offsets.get(name)
+        if ofs is not None:
+            return ofs
+        key = name[::-1]
+        i = bisect_left(self._tails, key)
+        if i < len(self._tails) and self._tails[i].startswith(key):
+            ofs = self._tail_ends[i] - len(name)
+            self._offsets[name] = ofs
+            self._names[ofs] = name
+            return ofs
+        return -1
+
+    def add_names(self, names):
+        """Return the offsets of @names, appending the missing ones to the
+        table in one write"""
+        found = {}
+        missing = []
+        for name in set(names):
+            if "\0" in name:
+                raise ValueError('0 in name %r' % name)
+            ofs = self.find_name(name)
+            if ofs < 0:
+                missing.append(name)
+            else:
+                found[name] = ofs
+        # by decreasing reversed name: a name comes after the longer ones
+        # it is the tail of, and is found in them
+        missing.sort(key=lambda n: n[::-1], reverse=True)
+        start = len(self.content)
+        pos = start
+        data = []
+        for name in missing:
+            ofs = self.find_name(name)
+            if ofs < 0:
+                ofs = pos
+                data.append(name + "\0")
+                pos += len(name) + 1
+                self.register_name(name, ofs)
+            found[name] = ofs
+        if data:
+            self._content += "".join(data)
+            self.resize(start, pos)
+            # the caches already hold the names appended
+            self._text = None
+            self._writes = self._content.writes
+        return [found[name] for name in names]
 
     def add_name(self, name):
-        if name in self.content:
-            return self.content.find(name)
-        n = len(self.content)
-        self.content = str(self.content) + name + "\0"
-        return n
+        return self.add_names([name])[0]
 
     def mod_name(self, name, new_name):
-        s = str(self.content)
-        if not name in s:
-            raise ValueError('unknown name', name)
-        s = s.replace('\x00' + name + '\x00', '\x00' + new_name + '\x00')
-        self.content = s
+        s = self.get_text()
+        old, new = '\x00' + name + '\x00', '\x00' + new_name + '\x00'
+        # names stored as the tail of a longer one cannot be changed
+        if not old in s:
+            raise ValueError('unknown name or shared tail', name)
+        if len(old) != len(new):
+            # the following names move
+            self.content = s.replace(old, new)
+            return len(self.content)
+        ofs = s.find(old)
+        while ofs >= 0:
+            self._content[ofs] = new
+            ofs = s.find(old, ofs + len(old))
+        self.invalidate()
         return len(self.content)
 
 
+class SymEntry32(new_cstruct.CStruct):
+    """Layout of the 32 bit symbols, for the SymTable columns"""
+    _fields = [("name", "u32"),
+               ("value", "u32"),
+               ("size", "u32"),
+               ("info", "u08"),
+               ("other", "u08"),
+               ("shndx", "u16")]
+
+
+class SymEntry64(new_cstruct.CStruct):
+    """Layout of the 64 bit symbols, for the SymTable columns"""
+    _fields = [("name", "u32"),
+               ("info", "u08"),
+               ("other", "u08"),
+               ("shndx", "u16"),
+               ("value", "u64"),
+               ("size", "u64")]
+
+
+class SymbolList(object):
+    """Read only sequence of the symbols of the SymTable @symtab, each one
+    wrapped on access"""
+
+    def __init__(self, symtab):
+        self.symtab = symtab
+
+    def __len__(self):
+        return len(self.symtab)
+
+    def __getitem__(self, item):
+        return self.symtab[item]
+
+    def __iter__(self):
+        return iter(self.symtab)
+
+    def __repr__(self):
+        return "<SymbolList of %d symbols>" % len(self)
+
+
 class SymTable(Section):
+    """
+    Symbols kept as a StructTable of raw entries, whose columns (name,
+    value, size, info, other, shndx) are decoded on demand; WSym wrappers
+    and names are only built for the symbols accessed. Name lookups go
+    through a multi-map, address lookups through a sorted index.
+    """
     sht = elf.SHT_SYMTAB
 
     def parse_content(self, sex, size):
         self.sex, self.size = sex, size
-        c = self.content
-        self.symtab = []
-        self.symbols = {}
-        sz = self.sh.entsize
-        index = 0
-        l = len(c)
         if size == 32:
-            WSym = WSym32
+            entry = SymEntry32
         elif size == 64:
-            WSym = WSym64
+            entry = SymEntry64
         else:
-            ValueError('unknown size')
-        while index < l:
-            s = c[index:index + sz]
-            index += sz
-            sym = WSym(self, sex, size, s)
-            self.symtab.append(sym)
-            self.symbols[sym.name] = sym
+            raise ValueError('unknown size')
+        c = self.content
+        itemsize = entry.get_table_layout('<', size)[1]
+        # ELF sex 1 is little endian, new_cstruct sex 0
+        self.table = entry.unpack_table(c, 0, len(c) / itemsize, None,
+                                        int(sex != 1), size)
+        self._wsyms = {}
+        self._names = None
+        self._name_index = None
+        self._addr_index = None
+        self._symbols = None
+
+    def __len__(self):
+        return len(self.table)
 
     def __getitem__(self, item):
         if type(item) is str:
-            return self.symbols[item]
-        return self.symtab[item]
+            syms = self.find_by_name(item)
+            if not syms:
+                raise KeyError(item)
+            # the last one, as in the former name dict
+            return syms[-1]
+        if isinstance(item, slice):
+            return [self[i] for i in xrange(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError('symbol index out of range')
+        sym = self._wsyms.get(item)
+        if sym is None:
+            if self.size == 32:
+                WSym = WSym32
+            else:
+                WSym = WSym64
+            sym = WSym(self, self.sex, self.size, self.table.raw(item))
+            self._wsyms[item] = sym
+        return sym
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def get_symtab(self):
+        return SymbolList(self)
+    symtab = property(get_symtab)
+
+    def get_symbols(self):
+        self.check_names()
+        if self._symbols is None:
+            self._symbols = dict(
+                (name, self[idx[-1]])
+                for name, idx in self.get_name_index().iteritems())
+        return self._symbols
+    symbols = property(get_symbols)
+
+    def invalidate_names(self):
+        """Drop the names cached, after the string table changed"""
+        self._names = None
+        self._name_index = None
+        self._symbols = None
+
+    def check_names(self):
+        """Drop the names cached if the string table has been written in
+        place since (see StrTable)"""
+        strtab = self.linksection
+        if hasattr(strtab, 'check_writes'):
+            strtab.check_writes()
+
+    def symbol_name(self, index):
+        """Return the name of the symbol @index"""
+        self.check_names()
+        if self._names is not None:
+            return self._names[index]
+        return self.linksection.get_name(self.table.get(index, 'name'))
+
+    def get_names(self):
+        """Return the names of all the symbols, resolved once"""
+        self.check_names()
+        if self._names is None:
+            offsets = self.table.column('name')
+            if numpy is not None:
+                offsets = offsets.tolist()
+            strtab = self.linksection
+            if hasattr(strtab, 'get_names'):
+                self._names = strtab.get_names(offsets)
+            else:
+                self._names = [strtab.get_name(o) for o in offsets]
+        return self._names
+
+    def get_name_index(self):
+        """Return {name: indexes of the symbols of this name}"""
+        self.check_names()
+        if self._name_index is None:
+            index = {}
+            for i, name in enumerate(self.get_names()):
+                index.setdefault(name, []).append(i)
+            self._name_index = index
+        return self._name_index
+
+    def get_addr_index(self):
+        """Return (sorted values, symbol indexes) of the defined symbols,
+        section and file symbols excepted"""
+        if self._addr_index is None:
+            values = self.table.column('value')
+            shndx = self.table.column('shndx')
+            info = self.table.column('info')
+            if numpy is not None:
+                stt = info & 0xf
+                keep = numpy.nonzero((shndx != elf.SHN_UNDEF) &
+                                     (stt != elf.STT_SECTION) &
+                                     (stt != elf.STT_FILE))[0]
+                order = keep[values[keep].argsort(kind='mergesort')]
+                # lists, compared exactly with 64 bit addresses
+                self._addr_index = (values[order].tolist(), order.tolist())
+            else:
+                order = [i for i in xrange(len(values))
+                         if shndx[i] != elf.SHN_UNDEF and
+                         info[i] & 0xf not in (elf.STT_SECTION, elf.STT_FILE)]
+                order.sort(key=values.__getitem__)
+                self._addr_index = ([values[i] for i in order], order)
+        return self._addr_index
+
+    def find_by_name(self, name):
+        """Return the symbols named @name, in table order"""
+        return [self[i] for i in self.get_name_index().get(name, [])]
+
+    def find_by_addr(self, ad):
+        """Return the defined symbol at @ad or the nearest before it, the
+        first one in table order if several share its value; None if
+        there is none"""
+        values, order = self.get_addr_index()
+        i = bisect_right(values, ad)
+        if not i:
+            return None
+        i = bisect_left(values, values[i - 1])
+        return self[order[i]]
+
+    def get_hash_sections(self):
+        """Return the hash tables of this table, the GNU ones first"""
+        hashes = [s for s in self.parent.shlist
+                  if isinstance(s, HashSection) and s.linksection is self]
+        hashes.sort(key=lambda s: not isinstance(s, GNUHashSection))
+        return hashes
+
+    def add_symbols(self, symbols, version=elf.VER_NDX_GLOBAL):
+        """
+        Append @symbols, (name, value, size, info, other, shndx) tuples,
+        then regenerate the hash tables of this table. Returns the indexes
+        of the symbols added, which the GNU hash table may reorder.
+        @version: index in the symbol version table of the symbols added,
+        or a list with one index per symbol
+        """
+        if self.size == 32:
+            entry = SymEntry32
+        else:
+            entry = SymEntry64
+        symbols = list(symbols)
+        if not isinstance(version, (list, tuple)):
+            version = [version] * len(symbols)
+        if len(version) != len(symbols):
+            raise ValueError('one version per symbol expected')
+        offsets = self.linksection.add_names([sym[0] for sym in symbols])
+        raw = []
+        for ofs, (name, value, size, info, other, shndx) in zip(offsets,
+                                                               symbols):
+            raw.append(entry(_sex=int(self.sex != 1), _wsize=self.size,
+                             name=ofs, value=value, size=size, info=info,
+                             other=other, shndx=shndx).pack())
+        first = len(self)
+        # the sections with one entry per symbol grow too
+        if self.sex == 1:
+            sex = '<'
+        else:
+            sex = '>'
+        for s in self.parent.shlist:
+            if s is self or s.linksection is not self:
+                continue
+            if isinstance(s, GNUVerSym):
+                s.content = str(s.content) + struct.pack(
+                    '%s%dH' % (sex, len(version)), *version)
+            elif isinstance(s, SymTabSHIndeces):
+                s.content = str(s.content) + '\x00' * 4 * len(symbols)
+        self.content = str(self.content) + "".join(raw)
+        position = range(len(self))
+        for h in self.get_hash_sections():
+            order = h.rebuild()
+            position = [position[i] for i in order]
+        added = {}
+        for new, old in enumerate(position):
+            if old >= first:
+                added[old] = new
+        return [added[i] for i in xrange(first, len(self))]
+
+    def reorder(self, order, keep=()):
+        """
+        Reorder the symbols, the new index i holding the former symbol
+        order[i]; the relocations, symbol versions and extended section
+        indexes of this table follow, and its hash tables but those in
+        @keep are rebuilt. A GNU hash table may reorder the symbols again:
+        returns the order finally applied.
+        """
+        if sorted(order) != range(len(self)):
+            raise ValueError('not a permutation of the symbols')
+        new_index = [0] * len(order)
+        for new, old in enumerate(order):
+            new_index[old] = new
+        for s in self.parent.shlist:
+            if s is self or s.linksection is not self:
+                continue
+            if isinstance(s, RelTable):
+                s.remap_symbols(new_index)
+            elif isinstance(s, (GNUVerSym, SymTabSHIndeces)):
+                # one entry per symbol
+                c = str(s.content)
+                sz = len(c) / max(len(order), 1)
+                s.content = "".join([c[i * sz:(i + 1) * sz] for i in order])
+        self.content = str(self.table.take(order))
+        for h in self.get_hash_sections():
+            if h not in keep:
+                order = [order[i] for i in h.rebuild()]
+        return order
 
 
 class DynSymTable(SymTable):
     sht = elf.SHT_DYNSYM
 
+    def lookup(self, name):
+        """Return the defined symbol @name, through the hash tables as the
+        dynamic loader does if there are some; None if there is none"""
+        for h in self.get_hash_sections():
+            return h.lookup(name)
+        for sym in self.find_by_name(name):
+            if sym.shndx != elf.SHN_UNDEF:
+                return sym
+        return None
+
 
 class RelTable(Section):
     sht = elf.SHT_REL
@@ -427,14 +1058,33 @@ class RelTable(Section):
 
         idx = 0
         while len(c) > sz*idx:
-            s = c[sz*idx:sz*(idx+1)]
+            rel = WRel(self, sex, size, c, sz*idx)
             idx += 1
-            rel = WRel(self, sex, size, s)
             self.reltab.append(rel)
             if rel.parent.linksection != self.parent.shlist[0]:
                 self.rel[rel.sym] = rel
 
 
+    def remap_symbols(self, new_index):
+        """Renumber the symbols of the relocations, @new_index giving the
+        new index of each former one"""
+        if self.sex == 1:
+            sex = '<'
+        else:
+            sex = '>'
+        if self.size == 32:
+            st, shift = struct.Struct(sex + 'I'), 8
+        else:
+            st, shift = struct.Struct(sex + 'Q'), 32
+        c = bytearray(str(self.content))
+        # r_info follows r_offset, one word
+        for of in xrange(self.size / 8, len(c), self.sh.entsize):
+            info = st.unpack_from(buffer(c), of)[0]
+            sym = new_index[info >> shift]
+            st.pack_into(c, of, (sym << shift) | (info & ((1 << shift) - 1)))
+        self.content = str(c)
+
+
 class RelATable(RelTable):
     sht = elf.SHT_RELA
 
@@ -460,7 +1110,8 @@ class SHList(object):
         for s in self.shlist:
             if not isinstance(s, NoBitsSection):
                 s._content = StrPatchwork(
-                    parent[s.sh.offset: s.sh.offset + s.sh.size])
+                    get_view(parent.content, s.sh.offset,
+                             s.sh.offset + s.sh.size))
         # Follow dependencies when initializing sections
         zero = self.shlist[0]
         todo = self.shlist[1:]
@@ -486,6 +1137,7 @@ class SHList(object):
     def append(self, item):
         self.do_add_section(item)
         self.shlist.append(item)
+        self.parent.invalidate_addr_index()
 
     def __getitem__(self, item):
         return self.shlist[item]
@@ -512,6 +1164,7 @@ class SHList(object):
             self.parent.Ehdr.shoff += diff
         if self.parent.Ehdr.phoff > sec.sh.offset:
             self.parent.Ehdr.phoff += diff
+        self.parent.invalidate_addr_index()
 
 # Program Header List
 
@@ -598,6 +1251,7 @@ class PHList(object):
                 p.ph.vaddr += diff
             if p.ph.paddr > sec.phparent.ph.paddr + sec.sh.offset:
                 p.ph.paddr += diff
+        self.parent.invalidate_addr_index()
 
 
 class virt(object):
@@ -607,16 +1261,7 @@ class virt(object):
 
     def get_rvaitem(self, start, stop=None):
         if stop == None:
-            s = self.parent.getsectionbyvad(start)
-            if s:
-                start = start - s.sh.addr
-            else:
-                s = self.parent.getphbyvad(start)
-                if s:
-                    start = start - s.ph.vaddr
-            if not s:
-                return [(None, start)]
-            return [(s, start)]
+            return [self.resolve(start)]
         total_len = stop - start
 
         virt_item = []
@@ -646,6 +1291,32 @@ class virt(object):
             virt_item.append((s, n_item))
         return virt_item
 
+    def resolve(self, ad):
+        """Return (section or segment, offset in it) for the virtual address
+        @ad; sections are preferred, (None, @ad) if @ad is not mapped"""
+        s = self.parent.getsectionbyvad(ad)
+        if s:
+            return (s, ad - s.sh.addr)
+        s = self.parent.getphbyvad(ad)
+        if s:
+            return (s, ad - s.ph.vaddr)
+        return (None, ad)
+
+    def resolve_many(self, addresses):
+        """Same as resolve for each of @addresses, in one pass"""
+        addresses = list(addresses)
+        out = []
+        secs = self.parent.getsectionsbyvad(addresses)
+        phs = self.parent.getphsbyvad(addresses)
+        for ad, s, p in zip(addresses, secs, phs):
+            if s:
+                out.append((s, ad - s.sh.addr))
+            elif p:
+                out.append((p, ad - p.ph.vaddr))
+            else:
+                out.append((None, ad))
+        return out
+
     def item2virtitem(self, item):
         if not type(item) is slice:  # integer
             return self.get_rvaitem(item)
@@ -739,13 +1410,38 @@ class virt(object):
         if offset < 0:
             offset = 0
         for s in sections:
-            data = self.parent.content[s.ph.offset:s.ph.offset + s.ph.filesz]
-            ret = data.find(pattern, offset)
+            ret = find_bytes(self.parent.content, pattern,
+                             s.ph.offset + offset, s.ph.offset + s.ph.filesz)
             if ret != -1:
-                return ret + s.ph.vaddr  # self.parent.rva2virt(s.addr + ret)
+                # self.parent.rva2virt(s.addr + ret)
+                return ret - s.ph.offset + s.ph.vaddr
             offset = 0
         return -1
 
+    def mapped_runs(self):
+        """Return the (virtual address, data) runs of contiguous memory
+        of the PT_LOAD segments, zero filled up to their memory size"""
+        content = self.parent.content
+        regions = []
+        for s in self.parent.ph:
+            if s.ph.type != elf.PT_LOAD:
+                continue
+            start, stop = s.ph.offset, s.ph.offset + s.ph.filesz
+            if isinstance(content, StrPatchwork):
+                data = content.view(start, stop)
+            else:
+                data = get_view(content, start, stop)
+            regions.append((s.ph.vaddr, max(s.ph.memsz, s.ph.filesz), data))
+        return contiguous_runs(regions)
+
+    def scan(self, patterns):
+        """Return the sorted (virtual address, pattern id) hits of
+        @patterns, a Scanner or its patterns, in one pass over the loaded
+        segments; matches may span segments"""
+        if not isinstance(patterns, Scanner):
+            patterns = Scanner(patterns)
+        return patterns.scan(self.mapped_runs())
+
 # ELF object
 
 
@@ -757,6 +1453,13 @@ class ELF(object):
 
         self._virt = virt(self)
 
+    @classmethod
+    def from_file(cls, path, mmap=True):
+        """Parse the file @path; if @mmap, it is memory mapped and
+        sections data is only copied when modified, and the file must not
+        be truncated or overwritten while the ELF is in use"""
+        return cls(read_file(path, mmap))
+
     def get_virt(self):
         return self._virt
     virt = property(get_virt)
@@ -764,13 +1467,96 @@ class ELF(object):
     content = ContentManager()
 
     def parse_content(self):
-        h = self.content[:8]
+        h = get_bytes(self.content, 0, 8)
         self.size = ord(h[4]) * 32
         self.sex = ord(h[5])
         self.Ehdr = WEhdr(self, self.sex, self.size, self.content)
+        self.invalidate_addr_index()
         self.sh = SHList(self, self.sex, self.size)
         self.ph = PHList(self, self.sex, self.size)
 
+    def invalidate_addr_index(self):
+        """Drop the address indexes; they are rebuilt on the next lookup.
+        Needed after changing a section or segment address or size, or
+        the symbols, by hand"""
+        self._sh_index = None
+        self._ph_index = None
+        self._sym_index = None
+
+    def get_sh_index(self):
+        if self._sh_index is None:
+            self._sh_index = AddrIndex([(s.sh.addr, s.sh.size, s)
+                                        for s in self.sh])
+        return self._sh_index
+
+    def get_ph_index(self):
+        if self._ph_index is None:
+            self._ph_index = AddrIndex([(s.ph.vaddr, s.ph.memsz, s)
+                                        for s in self.ph])
+        return self._ph_index
+
+    def get_sym_index(self):
+        """Return (SpanIndex of symbol ids, (table, index) of each id) over
+        the defined symbols of .symtab and .dynsym; .dynsym entries already
+        in .symtab are left out"""
+        if self._sym_index is None:
+            tables = [s for s in self.sh if isinstance(s, SymTable)]
+            tables.sort(key=lambda s: isinstance(s, DynSymTable))
+            spans, refs, known = [], [], set()
+            for t in tables:
+                value = t.table.column('value')
+                size = t.table.column('size')
+                info = t.table.column('info')
+                shndx = t.table.column('shndx')
+                if numpy is not None:
+                    value, size = value.tolist(), size.tolist()
+                    info, shndx = info.tolist(), shndx.tolist()
+                dyn = isinstance(t, DynSymTable)
+                for i in xrange(len(t)):
+                    # TLS symbol values are offsets in the TLS segment
+                    if shndx[i] == elf.SHN_UNDEF or info[i] & 0xf in (
+                            elf.STT_SECTION, elf.STT_FILE, elf.STT_TLS):
+                        continue
+                    if dyn:
+                        if (value[i], size[i]) in known and (
+                                value[i], size[i], t.symbol_name(i)) in known:
+                            continue
+                    else:
+                        known.add((value[i], size[i]))
+                        known.add((value[i], size[i], t.symbol_name(i)))
+                    spans.append((value[i], size[i], len(refs)))
+                    refs.append((t, i))
+            self._sym_index = (SpanIndex(spans), refs)
+        return self._sym_index
+
+    def symbolize(self, addrs):
+        """
+        Resolve the iterable of addresses @addrs to (symbol, offset) pairs,
+        None where no symbol holds the address. A symbol holds
+        [st_value, st_value + st_size), a symbol of size 0 only its own
+        address; among nested symbols the innermost one is chosen.
+        Meaningless for relocatable objects, whose st_value are offsets.
+        """
+        index, refs = self.get_sym_index()
+        syms = {}
+        out = []
+        for r in index.find_many(addrs):
+            if r is not None:
+                ident, off = r
+                sym = syms.get(ident)
+                if sym is None:
+                    t, i = refs[ident]
+                    sym = syms[ident] = t[i]
+                r = (sym, off)
+            out.append(r)
+        return out
+
+    def symbols_between(self, start, stop):
+        """Return the symbols overlapping [@start, @stop), by address"""
+        index, refs = self.get_sym_index()
+        return [refs[ident][0][refs[ident][1]]
+                for ident in index.overlapping(start, stop)]
+
     def resize(self, old, new):
         pass
 
@@ -790,14 +1576,16 @@ class ELF(object):
         return self.build_content()
 
     def getphbyvad(self, ad):
-        for s in self.ph:
-            if s.ph.vaddr <= ad < s.ph.vaddr + s.ph.memsz:
-                return s
+        return self.get_ph_index().find(ad)
 
     def getsectionbyvad(self, ad):
-        for s in self.sh:
-            if s.sh.addr <= ad < s.sh.addr + s.sh.size:
-                return s
+        return self.get_sh_index().find(ad)
+
+    def getphsbyvad(self, addresses):
+        return self.get_ph_index().find_many(addresses)
+
+    def getsectionsbyvad(self, addresses):
+        return self.get_sh_index().find_many(addresses)
 
     def getsectionbyname(self, name):
         for s in self.sh:
@@ -806,10 +1594,7 @@ class ELF(object):
         return None
 
     def is_in_virt_address(self, ad):
-        for s in self.sh:
-            if s.sh.addr <= ad < s.sh.addr + s.sh.size:
-                return True
-        return False
+        return self.get_sh_index().find(ad) is not None
 
 if __name__ == "__main__":
     import rlcompleter
@@ -818,6 +1603,45 @@ if __name__ == "__main__":
     from pprint import pprint as pp
     readline.parse_and_bind("tab: complete")
 
-    e = ELF(open("/bin/ls").read())
+    import sys
+    path = "/bin/ls"
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    e = ELF(open(path).read())
     print repr(e)
     # o = ELF(open("/tmp/svg-main.o").read())
+
+    # hash tables: lookups of every defined name, before and after they
+    # are rebuilt, then after symbols are added
+    def check_hashes(e, added=()):
+        for dynsym in e.sh:
+            if not isinstance(dynsym, DynSymTable):
+                continue
+            names = dynsym.get_names()
+            for h in dynsym.get_hash_sections():
+                for i, name in enumerate(names):
+                    if name and dynsym.table.get(i, 'shndx') != elf.SHN_UNDEF:
+                        sym = h.lookup(name)
+                        assert sym is not None and sym.name == name, name
+                for name in added:
+                    assert h.lookup(name).name == name
+                assert h.lookup("not a symbol name") is None
+            for s in e.sh:
+                if isinstance(s, GNUVerSym) and s.linksection is dynsym:
+                    assert len(s.content) == 2 * len(dynsym)
+    check_hashes(e)
+    relocs = [[r.sym for r in s.reltab]
+              for s in e.sh if isinstance(s, RelTable)]
+    for s in e.sh:
+        if isinstance(s, HashSection):
+            s.rebuild()
+    check_hashes(e)
+    added = ["selfcheck_%d" % i for i in xrange(100)]
+    e.sh.dynsym.add_symbols([(name, 0x1000 + i, 1, 0x12, 0, 1)
+                             for i, name in enumerate(added)])
+    check_hashes(e, added)
+    e = ELF(str(e))
+    check_hashes(e, added)
+    assert relocs == [[r.sym for r in s.reltab]
+                      for s in e.sh if isinstance(s, RelTable)]
+    print "hash tables ok"
@@ -0,0 +1,214 @@
+from bisect import bisect_left, bisect_right
+from heapq import heappush, heappop
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class AddrIndex(object):
+    """Sorted interval index over (start, size, item) triplets; lookups
+    return the first item, in the original order, containing the address,
+    like a linear scan would"""
+
+    def __init__(self, intervals):
+        intervals = sorted((start, i, start + size, item)
+                           for i, (start, size, item) in enumerate(intervals)
+                           if size > 0)
+        bounds = set()
+        for start, i, end, item in intervals:
+            bounds.add(start)
+            bounds.add(end)
+        self.bounds = sorted(bounds)
+        # self.items[k] owns [bounds[k], bounds[k+1]); sweep the bounds
+        # with a heap of the intervals seen so far, lowest rank on top
+        self.items = []
+        active = []
+        pos = 0
+        for ad in self.bounds[:-1]:
+            while pos < len(intervals) and intervals[pos][0] <= ad:
+                start, i, end, item = intervals[pos]
+                heappush(active, (i, end, item))
+                pos += 1
+            while active and active[0][1] <= ad:
+                heappop(active)
+            self.items.append(active[0][2] if active else None)
+
+    def find(self, ad):
+        k = bisect_right(self.bounds, ad) - 1
+        if 0 <= k < len(self.items):
+            return self.items[k]
+        return None
+
+    def find_many(self, addresses):
+        """Resolve the iterable @addresses in one pass over the index;
+        returns the list of items, None for unmapped addresses"""
+        addresses = list(addresses)
+        out = [None] * len(addresses)
+        bounds, items = self.bounds, self.items
+        k, nbounds = 0, len(bounds)
+        for j in sorted(xrange(len(addresses)), key=addresses.__getitem__):
+            ad = addresses[j]
+            while k < nbounds and bounds[k] <= ad:
+                k += 1
+            if 0 < k < nbounds:
+                out[j] = items[k - 1]
+        return out
+
+
+class SpanIndex(object):
+    """
+    Sorted index over (start, size, item) spans which may nest or overlap,
+    like symbols. An address resolves to the innermost span holding it:
+    the one starting last, then ending first, then first in the original
+    order. Empty spans only hold their start address, and only where no
+    other span does.
+    """
+
+    def __init__(self, spans):
+        sized, points = [], []
+        for i, (start, size, item) in enumerate(spans):
+            if size > 0:
+                sized.append((start, i, start + size, item))
+            else:
+                points.append((start, i, item))
+        sized.sort()
+        points.sort()
+        self.starts = [s[0] for s in sized]
+        self.ends = [s[2] for s in sized]
+        self.ranks = [s[1] for s in sized]
+        self.items = [s[3] for s in sized]
+        # highest end of the spans up to each one, for overlap queries
+        self.max_ends = []
+        top = None
+        for end in self.ends:
+            top = max(top, end)
+            self.max_ends.append(top)
+        self.points = points
+        self.point_starts = [p[0] for p in points]
+        self.first_point = {}
+        for start, i, item in reversed(points):
+            self.first_point[start] = item
+        # self.segments[k]: innermost span, by position, holding
+        # [bounds[k], bounds[k+1]), -1 if none; the heap keeps the spans
+        # seen so far, innermost on top
+        self.bounds = sorted(set(self.starts) | set(self.ends))
+        self.segments = []
+        active = []
+        pos = 0
+        for ad in self.bounds[:-1]:
+            while pos < len(sized) and self.starts[pos] <= ad:
+                heappush(active, (-self.starts[pos], self.ends[pos],
+                                  self.ranks[pos], pos))
+                pos += 1
+            while active and active[0][1] <= ad:
+                heappop(active)
+            self.segments.append(active[0][3] if active else -1)
+
+    def __len__(self):
+        return len(self.starts) + len(self.points)
+
+    def find(self, ad):
+        """Return (item, offset of @ad in it), None if no span holds @ad"""
+        k = bisect_right(self.bounds, ad) - 1
+        if 0 <= k < len(self.segments) and self.segments[k] >= 0:
+            pos = self.segments[k]
+            return self.items[pos], ad - self.starts[pos]
+        if ad in self.first_point:
+            return self.first_point[ad], 0
+        return None
+
+    def find_many(self, addresses):
+        """Resolve the iterable @addresses; returns the list of
+        (item, offset) pairs, None for the addresses no span holds"""
+        if numpy is None or not self.segments:
+            return [self.find(ad) for ad in addresses]
+        addresses = list(addresses)
+        # uint64 on both sides, compared exactly
+        ads = numpy.array(addresses, numpy.uint64)
+        bounds = numpy.array(self.bounds, numpy.uint64)
+        k = numpy.searchsorted(bounds, ads, 'right').astype(numpy.int64) - 1
+        inside = (k >= 0) & (k < len(self.segments))
+        pos = numpy.array(self.segments, numpy.int64)[numpy.where(inside,
+                                                                  k, 0)]
+        pos[~inside] = -1
+        starts = numpy.array(self.starts, numpy.uint64)
+        offsets = ads - starts[numpy.maximum(pos, 0)]
+        items, points = self.items, self.first_point
+        out = []
+        for ad, p, off in zip(addresses, pos.tolist(), offsets.tolist()):
+            if p >= 0:
+                out.append((items[p], off))
+            elif ad in points:
+                out.append((points[ad], 0))
+            else:
+                out.append(None)
+        return out
+
+    def overlapping(self, start, stop):
+        """Return the items of the spans overlapping [@start, @stop), by
+        start address then original order"""
+        if stop <= start:
+            return []
+        found = []
+        # spans before the first one whose max end exceeds start all end
+        # before it
+        first = bisect_right(self.max_ends, start)
+        last = bisect_left(self.starts, stop)
+        for pos in xrange(first, last):
+            if self.ends[pos] > start:
+                found.append((self.starts[pos], self.ranks[pos],
+                              self.items[pos]))
+        first = bisect_left(self.point_starts, start)
+        last = bisect_left(self.point_starts, stop)
+        found.extend(self.points[first:last])
+        found.sort(key=lambda f: f[:2])
+        return [f[2] for f in found]
+
+if __name__ == "__main__":
+    import random
+
+    def innermost(spans, ad):
+        # linear scan: latest start, then first end, then first in order
+        best = None
+        for i, (start, size, item) in enumerate(spans):
+            if size > 0 and start <= ad < start + size:
+                key = (-start, start + size, i)
+                if best is None or key < best[0]:
+                    best = key, (item, ad - start)
+        if best is not None:
+            return best[1]
+        for start, size, item in spans:
+            if size <= 0 and start == ad:
+                return item, 0
+        return None
+
+    rand = random.Random(0)
+    for with_numpy in [numpy is not None, False]:
+        if not with_numpy:
+            numpy = None
+        for n in [0, 1, 5, 50, 300]:
+            # nested, overlapping, empty and 64 bit spans
+            base = rand.choice([0, 0xffffffff00000000])
+            spans = [(base + rand.randrange(1000), rand.choice([0, 1, 3, 40,
+                      rand.randrange(300)]), i) for i in xrange(n)]
+            index = SpanIndex(spans)
+            addrs = [base + rand.randrange(-10, 1400) for _ in xrange(500)]
+            expected = [innermost(spans, ad) for ad in addrs]
+            assert [index.find(ad) for ad in addrs] == expected
+            assert index.find_many(addrs) == expected
+            for _ in xrange(200):
+                start = base + rand.randrange(-10, 1400)
+                stop = start + rand.randrange(1, 100)
+                found = sorted((s, i) for s, size, i in spans
+                               if (size > 0 and s < stop and s + size > start)
+                               or (size <= 0 and start <= s < stop))
+                assert index.overlapping(start, stop) == [i for s, i in found]
+                assert index.overlapping(start, start) == []
+            # AddrIndex: first interval in order holding the address
+            first = AddrIndex(spans)
+            for ad in addrs:
+                hits = [i for s, size, i in spans if s <= ad < s + size]
+                assert first.find(ad) == (hits[0] if hits else None)
+            assert first.find_many(addrs) == [first.find(ad) for ad in addrs]
+    print "ok"
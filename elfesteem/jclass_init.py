@@ -2,7 +2,7 @@
 
 import struct
 import array
-from strpatchwork import StrPatchwork
+from strpatchwork import StrPatchwork, get_bytes, read_file
 from new_cstruct import CStruct
 import logging
 from collections import defaultdict
@@ -59,7 +59,7 @@ class CPUtf8(CStruct):
                ]
 
     def gets(self, s, of):
-        v = s[of:of + self.length]
+        v = get_bytes(s, of, of + self.length)
         return v, of + self.length
 
     def sets(self, value):
@@ -296,7 +296,7 @@ class CPoolfield(CStruct):
 
     @classmethod
     def unpack_l(cls, s, off=0, parent_head=None, _sex=1, _wsize=32):
-        tag = ord(s[off])
+        tag = ord(get_bytes(s, off, off + 1))
         if not tag in CONSTANT_TYPES:
             raise ValueError('unknown type', hex(tag))
         c, l = CONSTANT_TYPES[tag].unpack_l(s, off, parent_head, _sex, _wsize)
@@ -335,9 +335,12 @@ class CAttribute_code(CStruct):
                ]
 
     def getcode(self, s, of):
-        v = s[of:of + self.code_length]
+        v = get_bytes(s, of, of + self.code_length)
         return v, of + self.code_length
 
+    def skip_code(self, s, of):
+        return of + self.code_length
+
     def setcode(self, value):
         return str(value)
 
@@ -443,7 +446,7 @@ class CAttributeInfo_default(CStruct):
         return self.parent_head.get_constant_pool_by_index(self.name_value).value
 
     def getcode(self, s, of):
-        v = s[of:of + self.attribute_length]
+        v = get_bytes(s, of, of + self.attribute_length)
         return v, of + self.attribute_length
 
     def setcode(self, value):
@@ -579,6 +582,13 @@ class JCLASS(object):
         self._content = pestr
         self.parse_content()
 
+    @classmethod
+    def from_file(cls, path, mmap=True):
+        """Parse the file @path; if @mmap, it is memory mapped instead of
+        read, and must not be truncated or overwritten while the class is
+        in use"""
+        return cls(read_file(path, mmap))
+
     def get_constant_pool_by_index(self, index):
         index -= 1
         if 0 <= index < len(self.hdr.constants_pool):
@@ -30,6 +30,7 @@ class Rva(CStruct):
     """Relative Virtual Address
     Note: RVA in Minidump means "file offset"
     """
+    _compact = True
     _fields = [("rva", "u32"),
     ]
 
@@ -80,6 +81,7 @@ class LocationDescriptor(CStruct):
     """MINIDUMP_LOCATION_DESCRIPTOR
     https://msdn.microsoft.com/en-us/library/ms680383(v=vs.85).aspx
     """
+    _compact = True
     _fields = [("DataSize", "u32"),
                ("Rva", "Rva"),
     ]
@@ -180,6 +182,7 @@ class MemoryDescriptor64(CStruct):
     """MINIDUMP_MEMORY_DESCRIPTOR64
     https://msdn.microsoft.com/en-us/library/ms680384(v=vs.85).aspx
     """
+    _compact = True
     _fields = [("StartOfMemoryRange", "u64"),
                ("DataSize", "u64")
     ]
@@ -199,6 +202,7 @@ class MemoryDescriptor(CStruct):
     """MINIDUMP_MEMORY_DESCRIPTOR
     https://msdn.microsoft.com/en-us/library/ms680384(v=vs.85).aspx
     """
+    _compact = True
     _fields = [("StartOfMemoryRange", "u64"),
                ("Memory", "LocationDescriptor"),
     ]
@@ -232,6 +236,7 @@ class MemoryInfo(CStruct):
     """MINIDUMP_MEMORY_INFO
     https://msdn.microsoft.com/en-us/library/ms680386(v=vs.85).aspx
     """
+    _compact = True
     _fields = [("BaseAddress", "u64"),
                ("AllocationBase", "u64"),
                ("AllocationProtect", "u32"),
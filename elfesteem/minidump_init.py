@@ -1,7 +1,7 @@
 """
 High-level abstraction of Minidump file
 """
-from strpatchwork import StrPatchwork
+from strpatchwork import StrPatchwork, read_file
 import minidump as mp
 
 
@@ -86,6 +86,13 @@ class Minidump(object):
         self.memory = {} # base address (virtual) -> Memory information
         self.build_memory()
 
+    @classmethod
+    def from_file(cls, path, mmap=True):
+        """Parse the file @path; if @mmap, it is memory mapped instead of
+        read, and must not be truncated or overwritten while the minidump
+        is in use"""
+        return cls(read_file(path, mmap))
+
     def parse_content(self):
         """Build structures corresponding to current content"""
 
@@ -167,6 +174,45 @@ class Minidump(object):
         if mode64:
             assert all(addr in self.memory for addr in addr2module)
 
+    def stream_offset(self, stream_type):
+        """Return the offset of the first stream of type @stream_type, or
+        None"""
+        for stream in self.streams:
+            if stream.StreamType == stream_type:
+                return stream.Location.Rva.rva
+        return None
+
+    @property
+    def memory_table(self):
+        """StructTable of the MemoryDescriptor64 (or MemoryDescriptor, if
+        the dump is not a full memory one) of the memory list stream; None
+        if the dump has no such stream"""
+        if self.minidumpHDR.Flags & mp.minidumpType.MiniDumpWithFullMemory:
+            if self.memory64list is None:
+                return None
+            offset = self.stream_offset(mp.streamType.Memory64ListStream)
+            # NumberOfMemoryRanges, BaseRva
+            return mp.MemoryDescriptor64.unpack_table(
+                self._content, offset + 16,
+                self.memory64list.NumberOfMemoryRanges, self)
+        if self.memorylist is None:
+            return None
+        offset = self.stream_offset(mp.streamType.MemoryListStream)
+        # NumberOfMemoryRanges
+        return mp.MemoryDescriptor.unpack_table(
+            self._content, offset + 4,
+            self.memorylist.NumberOfMemoryRanges, self)
+
+    @property
+    def memoryinfo_table(self):
+        """StructTable of the MemoryInfo of the memory info list stream"""
+        if self.memoryinfolist is None:
+            return None
+        offset = self.stream_offset(mp.streamType.MemoryInfoListStream)
+        return mp.MemoryInfo.unpack_table(
+            self._content, offset + self.memoryinfolist.SizeOfHeader,
+            self.memoryinfolist.NumberOfEntries, self)
+
     def get(self, virt_start, virt_stop):
         """Return the content at the (virtual addresses)
         [virt_start:virt_stop]"""
@@ -1,7 +1,14 @@
 #! /usr/bin/env python
 
 import struct
+import sys
 import re
+from array import array
+from strpatchwork import buffer_types, unpack_from, find_bytes, get_bytes
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 type2realtype = {}
 size2type = {}
@@ -33,6 +40,8 @@ type2realtype['q'] = 'q'
 type2realtype['ptr'] = 'ptr'
 
 sex_types = {0: '<', 1: '>'}
+sex_types_inv = {'<': 0, '>': 1}
+native_sex = '<' if sys.byteorder == 'little' else '>'
 
 
 def fix_size(fields, wsize):
@@ -63,29 +72,295 @@ def real_fmt(fmt, wsize):
 all_cstructs = {}
 
 
+def is_basic_type(ffmt):
+    return ffmt in type2realtype or (isinstance(ffmt, str) and
+                                     re.match(r'\d+s', ffmt) is not None)
+
+
+# unpack plan steps
+STEP_RUN = 0     # run of fixed size scalar fields, merged in one struct
+STEP_ARRAY = 1   # counted array of scalars
+STEP_SZ = 2      # null terminated string
+STEP_SUB = 3     # sub structure (or counted array of sub structures)
+STEP_CUSTOM = 4  # custom (getter, setter) tuple
+
+
+def compile_plan(cls, sex, wsize):
+    """
+    Build the unpack plan of @cls for @sex/@wsize: consecutive fixed size
+    scalar fields are merged into a single precompiled struct.Struct, other
+    fields are kept as one step each.
+    Steps are (kind, struct or getter or class name, field name(s), count,
+    extra), where extra is the default values of a run, or the setter of a
+    custom field.
+    """
+    plan = []
+    run_fmt, run_names, run_offsets = [], [], []
+
+    def flush_run():
+        if not run_names:
+            return
+        st = struct.Struct(sex + "".join(run_fmt))
+        # None values are packed as zeros
+        defaults = tuple(['' if f.endswith('s') else 0 for f in run_fmt])
+        # for runs, the count item is the offset of the last field
+        plan.append((STEP_RUN, st, tuple(run_names), run_offsets[-1],
+                     defaults))
+        del run_fmt[:], run_names[:], run_offsets[:]
+
+    for field in cls._fields:
+        cpt = None
+        if len(field) == 2:
+            fname, ffmt = field
+        elif len(field) == 3:
+            fname, ffmt, cpt = field
+        name = cls._value_names[fname]
+        if is_basic_type(ffmt):
+            fmt = real_fmt(ffmt, wsize)
+            if cpt is None:
+                run_offsets.append(struct.calcsize(sex + "".join(run_fmt)))
+                run_fmt.append(fmt)
+                run_names.append(name)
+                continue
+            flush_run()
+            plan.append((STEP_ARRAY, struct.Struct(sex + fmt), name, cpt,
+                         None))
+        elif ffmt == "sz":
+            flush_run()
+            plan.append((STEP_SZ, None, name, None, None))
+        elif ffmt in all_cstructs:
+            flush_run()
+            # the sub structure class is resolved at unpack time
+            plan.append((STEP_SUB, ffmt, name, cpt, None))
+        elif isinstance(ffmt, tuple):
+            flush_run()
+            plan.append((STEP_CUSTOM, ffmt[0], name, None, ffmt[1]))
+        else:
+            raise ValueError('unknown class', ffmt)
+    flush_run()
+    return plan
+
+
+def table_layout(cls, sex, wsize):
+    """
+    Return the list of (column name, format, offset) of @cls and its size;
+    sub structures are flattened as 'field.subfield'.
+    Classes with custom fields may give a fixed layout in _table_fields.
+    Raise ValueError if @cls has no fixed layout.
+    """
+    columns = []
+
+    def walk(cls, prefix, of):
+        if getattr(cls.unpack_l, 'im_func', None) is not default_unpack_l:
+            raise ValueError('custom unpack', cls.__name__)
+        for field in getattr(cls, '_table_fields', cls._fields):
+            if len(field) != 2:
+                raise ValueError('counted field', field[0])
+            fname, ffmt = field
+            if is_basic_type(ffmt):
+                fmt = real_fmt(ffmt, wsize)
+                columns.append((prefix + fname, fmt, of))
+                of += struct.calcsize(sex + fmt)
+            elif ffmt in all_cstructs:
+                of = walk(all_cstructs[ffmt], prefix + fname + '.', of)
+            else:
+                raise ValueError('not a fixed size field', fname)
+        return of
+
+    return columns, walk(cls, '', 0)
+
+
+# array typecodes of struct formats, when they have the same size
+fmt2array = {}
+for t in 'bBhHiIqQfd':
+    tc = {'q': 'l', 'Q': 'L'}.get(t, t)
+    if array(tc).itemsize == struct.calcsize(t):
+        fmt2array[t] = tc
+
+
+def write_into(buf, off, data):
+    """
+    Write @data in @buf at @off without resizing @buf; returns the offset
+    following the written data
+    """
+    end = off + len(data)
+    if not 0 <= off <= end <= len(buf):
+        raise struct.error('pack_into requires a buffer of at least %d bytes'
+                           % end)
+    buf[off:end] = data
+    return end
+
+
+def decode_field(c, kind, st, cpt, s, of1, parent_head, _sex, _wsize):
+    """
+    Decode the field of @c described by the plan step (@kind, @st, @cpt)
+    at @of1 in @s; returns its value and end offset
+    """
+    if kind == STEP_ARRAY:
+        count = max(cpt(c), 0)
+        of2 = of1 + count * st.size
+        if st.format[-1] == "s":
+            value = [unpack_from(st, s, of)[0]
+                     for of in xrange(of1, of2, st.size)]
+        else:
+            fmt = "%s%d%s" % (st.format[0], count, st.format[1:])
+            if isinstance(s, buffer_types):
+                value = list(struct.unpack_from(fmt, s, of1))
+            else:
+                value = list(struct.unpack(fmt, s[of1:of2]))
+    elif kind == STEP_SZ:  # null terminated special case
+        of2 = find_bytes(s, '\x00', of1)
+        if of2 == -1:
+            raise ValueError('no null char in string!')
+        value = get_bytes(s, of1, of2)
+        of2 += 1
+    elif kind == STEP_SUB:
+        # sub structures
+        sub_cls = all_cstructs[st]
+        if cpt:
+            value = []
+            of2 = of1
+            for i in xrange(cpt(c)):
+                v, l = sub_cls.unpack_l(s, of2, parent_head, _sex, _wsize)
+                v.parent = c
+                value.append(v)
+                of2 += l
+        else:
+            value, l = sub_cls.unpack_l(s, of1, parent_head, _sex, _wsize)
+            value.parent = c
+            of2 = of1 + l
+    else:
+        value, of2 = st(c, s, of1)
+    return value, of2
+
+
+def skip_field(c, kind, st, name, cpt, s, of1):
+    """
+    Return the end offset of the field of @c described by the plan step
+    (@kind, @st, @name, @cpt) at @of1 in @s without decoding it, or None if
+    it cannot be known
+    """
+    skip = getattr(c, 'skip_' + c._field_names[name], None)
+    if skip is not None:
+        return skip(s, of1)
+    if kind == STEP_ARRAY:
+        return of1 + max(cpt(c), 0) * st.size
+    if kind == STEP_SZ:
+        of2 = find_bytes(s, '\x00', of1)
+        if of2 == -1:
+            return None
+        return of2 + 1
+    if kind == STEP_SUB:
+        size = all_cstructs[st].fixed_size(c.sex, c._wsize)
+        if size is None:
+            return None
+        if cpt:
+            return of1 + max(cpt(c), 0) * size
+        return of1 + size
+    return None
+
+
+class Layout(object):
+    """
+    Sex, word size and unpack plan shared by all the compact instances of a
+    class
+    """
+    __slots__ = ["_sex", "_wsize", "sex", "plan"]
+
+    def __init__(self, cls, _sex, _wsize):
+        if cls._packformat:
+            self.sex = cls._packformat
+        else:
+            self.sex = sex_types[_sex]
+        self._sex = sex_types_inv.get(self.sex, _sex)
+        self._wsize = _wsize
+        self.plan = cls.get_plan(self.sex, _wsize)
+
+
 class Cstruct_Metaclass(type):
     field_suffix = "_value"
 
     def __new__(cls, name, bases, dct):
+        compact = dct.get('_compact', False)
+        value_names = {}
         for fields in dct['_fields']:
             fname = fields[0]
             if fname in ['parent', 'parent_head']:
                 raise ValueError('field name will confuse internal structs',
                                  repr(fname))
-            dct[fname] = property(dct.pop("get_" + fname,
-                                          lambda self, fname=fname: getattr(
-                                              self, fname + self.__class__.field_suffix)),
-                                  dct.pop("set_" + fname,
-                                          lambda self, v, fname=fname: setattr(
-                                              self, fname + self.__class__.field_suffix, v)),
-                                  dct.pop("del_" + fname, None))
+            f_get = dct.pop("get_" + fname, None)
+            f_set = dct.pop("set_" + fname, None)
+            f_del = dct.pop("del_" + fname, None)
+            value_name = fname + cls.field_suffix
+            if compact and fname.startswith('__'):
+                # avoid private name mangling of the slot
+                value_name = '_s' + value_name
+            elif compact and f_get is f_set is f_del is None:
+                # the value is stored in a slot named after the field;
+                # <field>_value is kept as an alias
+                value_names[fname] = fname
+                dct[value_name] = property(
+                    lambda self, fname=fname: getattr(self, fname),
+                    lambda self, v, fname=fname: setattr(self, fname, v))
+                continue
+            value_names[fname] = value_name
+            if f_get is None:
+                f_get = lambda self, value_name=value_name: getattr(
+                    self, value_name)
+            if f_set is None:
+                f_set = lambda self, v, value_name=value_name: setattr(
+                    self, value_name, v)
+            dct[fname] = property(f_get, f_set, f_del)
+        if compact:
+            dct['__slots__'] = tuple(value_names.values()) + (
+                'parent_head', 'parent', '_layout', '_lazy')
+            for attr in Layout.__slots__:
+                dct[attr] = property(
+                    lambda self, attr=attr: getattr(self._layout, attr))
 
         o = super(Cstruct_Metaclass, cls).__new__(cls, name, bases, dct)
+        o._value_names = value_names
+        o._field_names = dict((v, k) for k, v in value_names.items())
+        # compiled unpack plans, by (sex, wsize)
+        o._plans = {}
+        # shared layouts of compact instances, by (_sex, _wsize)
+        o._layouts = {}
+        o._empty_values = dict.fromkeys(value_names.values())
+        # fixed layouts used by StructTable, by (sex, wsize)
+        o._table_layouts = {}
         if name != "CStruct":
             all_cstructs[name] = o
         return o
 
-    def unpack_l(cls, s, off=0, parent_head=None, _sex=None, _wsize=None):
+    def get_plan(cls, sex, wsize):
+        key = (sex, wsize)
+        plan = cls._plans.get(key)
+        if plan is None:
+            plan = compile_plan(cls, sex, wsize)
+            cls._plans[key] = plan
+        return plan
+
+    def get_layout(cls, _sex, _wsize):
+        key = (_sex, _wsize)
+        layout = cls._layouts.get(key)
+        if layout is None:
+            layout = Layout(cls, _sex, _wsize)
+            # avoid keeping a reference on a custom _sex object
+            cls._layouts[(layout._sex, _wsize)] = layout
+        return layout
+
+    def unpack_l(cls, s, off=0, parent_head=None, _sex=None, _wsize=None,
+                 lazy=False):
+        """
+        Unpack an instance of @cls at @off in @s; returns it and its length.
+        If @lazy, fields other than basic types are only decoded on first
+        access: their length is found by a skip_<field>(s, of) method
+        returning the end offset if the class has one, or without decoding
+        them for arrays, strings and fixed size sub structures. Other
+        fields are decoded, but for the last one: the length returned is
+        then None, as it is not known. @s must not be modified until the
+        fields are accessed.
+        """
         if _sex is None and _wsize is None:
             # get sex and size from parent
             if parent_head is not None:
@@ -99,79 +374,106 @@ class Cstruct_Metaclass(type):
             parent_head = c
         c.parent_head = parent_head
 
+        # buffers are decoded in place
+        direct = isinstance(s, buffer_types)
+        compact = cls._compact
         of1 = off
-        for field in c._fields:
-            cpt = None
-            if len(field) == 2:
-                fname, ffmt = field
-            elif len(field) == 3:
-                fname, ffmt, cpt = field
-            if ffmt in type2realtype or (isinstance(ffmt, str) and re.match(r'\d+s', ffmt)):
+        plan = cls.get_plan(c.sex, _wsize)
+        length_known = True
+        if lazy:
+            # field value name -> (kind, struct, count, string, offset)
+            c._lazy = {}
+            last = len(plan) - 1
+        for i, (kind, st, name, cpt, extra) in enumerate(plan):
+            if kind == STEP_RUN:
                 # basic types
-                if cpt:
-                    value = []
-                    i = 0
-                    while i < cpt(c):
-                        fmt = real_fmt(ffmt, _wsize)
-                        of2 = of1 + struct.calcsize(fmt)
-                        value.append(struct.unpack(c.sex + fmt, s[of1:of2])[0])
-                        of1 = of2
-                        i += 1
+                if not (0 <= of1 and of1 + cpt < len(s)):
+                    raise RuntimeError("not enought data")
+                if direct:
+                    value = st.unpack_from(s, of1)
                 else:
-                    fmt = real_fmt(ffmt, _wsize)
-                    of2 = of1 + struct.calcsize(fmt)
-                    if not (0 <= of1 < len(s) and 0 <= of1 < len(s)):
-                        raise RuntimeError("not enought data")
-                    value = struct.unpack(c.sex + fmt, s[of1:of2])[0]
-            elif ffmt == "sz":  # null terminated special case
-                of2 = s.find('\x00', of1)
-                if of2 == -1:
-                    raise ValueError('no null char in string!')
-                of2 += 1
-                value = s[of1:of2 - 1]
-            elif ffmt in all_cstructs:
-                of2 = of1
-                # sub structures
-                if cpt:
-                    value = []
-                    i = 0
-                    while i < cpt(c):
-                        v, l = all_cstructs[ffmt].unpack_l(
-                            s, of1, parent_head, _sex, _wsize)
-                        v.parent = c
-                        value.append(v)
-                        of2 = of1 + l
-                        of1 = of2
-                        i += 1
+                    value = unpack_from(st, s, of1)
+                if compact:
+                    for n, v in zip(name, value):
+                        setattr(c, n, v)
                 else:
-                    value, l = all_cstructs[ffmt].unpack_l(
-                        s, of1, parent_head, _sex, _wsize)
-                    value.parent = c
-                    of2 = of1 + l
-            elif isinstance(ffmt, tuple):
-                f_get, f_set = ffmt
-                value, of2 = f_get(c, s, of1)
-            else:
-                raise ValueError('unknown class', ffmt)
-            of1 = of2
-            setattr(c, fname + c.__class__.field_suffix, value)
-
-        return c, of2 - off
-
-    def unpack(cls, s, off=0, parent_head=None, _sex=None, _wsize=None):
-        c, l = cls.unpack_l(s, off=off,
-                            parent_head=parent_head, _sex=_sex, _wsize=_wsize)
+                    c.__dict__.update(zip(name, value))
+                of1 += st.size
+                continue
+            if lazy:
+                of2 = skip_field(c, kind, st, name, cpt, s, of1)
+                if of2 is None and i == last:
+                    # trailing field of unknown length
+                    of2 = of1
+                    length_known = False
+                elif of2 is None:
+                    value, of1 = decode_field(c, kind, st, cpt, s, of1,
+                                              parent_head, _sex, _wsize)
+                    setattr(c, name, value)
+                    continue
+                c._lazy[name] = (kind, st, cpt, s, of1)
+                delattr(c, name)
+                of1 = of2
+                continue
+            value, of1 = decode_field(c, kind, st, cpt, s, of1,
+                                      parent_head, _sex, _wsize)
+            setattr(c, name, value)
+
+        if not length_known:
+            return c, None
+        return c, of1 - off
+
+    def unpack(cls, s, off=0, parent_head=None, _sex=None, _wsize=None,
+               lazy=False):
+        c, l = cls.unpack_l(s, off=off, parent_head=parent_head,
+                            _sex=_sex, _wsize=_wsize, lazy=lazy)
         return c
 
+    def fixed_size(cls, sex, wsize):
+        """Return the size of @cls if it has a fixed layout, else None"""
+        try:
+            return cls.get_table_layout(sex, wsize)[1]
+        except ValueError:
+            return None
+
+    def get_table_layout(cls, sex, wsize):
+        key = (sex, wsize)
+        layout = cls._table_layouts.get(key)
+        if layout is None:
+            try:
+                layout = table_layout(cls, sex, wsize)
+            except ValueError, e:
+                layout = e
+            cls._table_layouts[key] = layout
+        if isinstance(layout, ValueError):
+            raise layout
+        return layout
+
+    def unpack_table(cls, s, off=0, count=0, parent_head=None, _sex=None,
+                     _wsize=None):
+        """
+        Return a StructTable of @count @cls elements stored at @off in @s
+        """
+        return StructTable(cls, s, off, count, parent_head, _sex, _wsize)
+
+
+default_unpack_l = Cstruct_Metaclass.__dict__['unpack_l']
+
 
 class CStruct(object):
+    """
+    Subclasses setting _compact to True store their fields in __slots__ and
+    share their sex, word size and unpack plan through a Layout object; such
+    instances cannot hold extra attributes.
+    """
     __metaclass__ = Cstruct_Metaclass
+    __slots__ = ()
     _packformat = ""
     _fields = []
+    _compact = False
 
     def __init__(self, parent_head=None, _sex=None, _wsize=None, **kargs):
         self.parent_head = parent_head
-        self._size = None
         kargs = dict(kargs)
         # if not sex or size: get the one of the parent
         if _sex == None and _wsize == None:
@@ -182,6 +484,14 @@ class CStruct(object):
                 # else default sex & size
                 _sex = 0
                 _size = 32
+        if self._compact:
+            self._layout = self.__class__.get_layout(_sex, _wsize)
+            for k in self._empty_values:
+                setattr(self, k, None)
+            for k, v in kargs.items():
+                setattr(self, self._value_names.get(k, k), v)
+            return
+        self._size = None
         # _sex is 0 or 1, sex is '<' or '>'
         self._sex = _sex
         self._wsize = _wsize
@@ -189,63 +499,131 @@ class CStruct(object):
             self.sex = self._packformat
         else:
             self.sex = sex_types[_sex]
-        for f in self._fields:
-            setattr(self, f[0] + self.__class__.field_suffix, None)
+        self.__dict__.update(self._empty_values)
         if kargs:
             for k, v in kargs.items():
                 self.__dict__[k + self.__class__.field_suffix] = v
 
     def pack(self):
-        out = ''
-        for field in self._fields:
-            cpt = None
-            if len(field) == 2:
-                fname, ffmt = field
-            elif len(field) == 3:
-                fname, ffmt, cpt = field
-
-            value = getattr(self, fname + self.__class__.field_suffix)
-            if ffmt in type2realtype or (isinstance(ffmt, str) and re.match(r'\d+s', ffmt)):
+        out = []
+        plan = self.__class__.get_plan(self.sex, self._wsize)
+        for kind, st, name, cpt, extra in plan:
+            if kind == STEP_RUN:
                 # basic types
-                fmt = real_fmt(ffmt, self._wsize)
-                if cpt == None:
-                    if value == None:
-                        o = struct.calcsize(fmt) * "\x00"
-                    else:
-                        o = struct.pack(self.sex + fmt, value)
+                values = [getattr(self, n) for n in name]
+                if None in values:
+                    values = [d if v is None else v
+                              for v, d in zip(values, extra)]
+                out.append(st.pack(*values))
+                continue
+            value = getattr(self, name)
+            if kind == STEP_ARRAY:
+                if st.format[-1] == "s":
+                    out += [st.pack(v) for v in value]
                 else:
-                    o = ""
-                    for v in value:
-                        if value == None:
-                            o += struct.calcsize(fmt) * "\x00"
-                        else:
-                            o += struct.pack(self.sex + fmt, v)
-
-            elif ffmt == "sz":  # null terminated special case
-                o = value + '\x00'
-            elif ffmt in all_cstructs:
+                    fmt = "%s%d%s" % (st.format[0], len(value), st.format[1:])
+                    out.append(struct.pack(fmt, *value))
+            elif kind == STEP_SZ:  # null terminated special case
+                out.append(value)
+                out.append('\x00')
+            elif kind == STEP_SUB:
                 # sub structures
                 if cpt == None:
-                    o = str(value)
+                    out.append(str(value))
                 else:
-                    o = ""
+                    out += [str(v) for v in value]
+            else:
+                out.append(extra(self, value))
+        return "".join(out)
+
+    def packed_size(self):
+        """
+        Return the length of the packed structure; only custom fields and
+        non CStruct sub structures are serialized to compute it.
+        """
+        size = 0
+        plan = self.__class__.get_plan(self.sex, self._wsize)
+        for kind, st, name, cpt, extra in plan:
+            if kind == STEP_RUN:
+                size += st.size
+                continue
+            value = getattr(self, name)
+            if kind == STEP_ARRAY:
+                size += len(value) * st.size
+            elif kind == STEP_SZ:
+                size += len(value) + 1
+            elif kind == STEP_SUB:
+                if cpt == None:
+                    value = [value]
+                for v in value:
+                    if isinstance(v, CStruct):
+                        size += v.packed_size()
+                    else:
+                        size += len(str(v))
+            else:
+                size += len(extra(self, value))
+        return size
+
+    def pack_into(self, buf, off=0):
+        """
+        Pack the structure in the writable buffer @buf (bytearray,
+        memoryview, ...) at offset @off
+        Returns the number of bytes written
+        """
+        of = off
+        plan = self.__class__.get_plan(self.sex, self._wsize)
+        for kind, st, name, cpt, extra in plan:
+            if kind == STEP_RUN:
+                values = [getattr(self, n) for n in name]
+                if None in values:
+                    values = [d if v is None else v
+                              for v, d in zip(values, extra)]
+                st.pack_into(buf, of, *values)
+                of += st.size
+                continue
+            value = getattr(self, name)
+            if kind == STEP_ARRAY:
+                if st.format[-1] == "s":
                     for v in value:
-                        o += str(v)
-            elif isinstance(ffmt, tuple):
-                f_get, f_set = ffmt
-                o = f_set(self, value)
-
+                        st.pack_into(buf, of, v)
+                        of += st.size
+                else:
+                    fmt = "%s%d%s" % (st.format[0], len(value), st.format[1:])
+                    struct.pack_into(fmt, buf, of, *value)
+                    of += len(value) * st.size
+            elif kind == STEP_SZ:
+                of = write_into(buf, of, value + '\x00')
+            elif kind == STEP_SUB:
+                if cpt == None:
+                    value = [value]
+                for v in value:
+                    if isinstance(v, CStruct):
+                        of += v.pack_into(buf, of)
+                    else:
+                        of = write_into(buf, of, str(v))
             else:
-                raise ValueError('unknown class', ffmt)
-            out += o
-
-        return out
+                of = write_into(buf, of, extra(self, value))
+        return of - off
+
+    def __getattr__(self, name):
+        # only called for missing attributes: fields left by a lazy unpack
+        if name != '_lazy':
+            lazy = getattr(self, '_lazy', None)
+            if lazy and name in lazy:
+                kind, st, cpt, s, of = lazy[name]
+                value, of = decode_field(self, kind, st, cpt, s, of,
+                                         self.parent_head, self._sex,
+                                         self._wsize)
+                del lazy[name]
+                setattr(self, name, value)
+                return value
+        raise AttributeError(name)
 
     def __str__(self):
         return self.pack()
 
     def __len__(self):
-        return len(self.pack())
+        return self.packed_size()
 
     def __repr__(self):
         return "<%s=%s>" % (self.__class__.__name__, "/".join(map(lambda x: repr(getattr(self, x[0])), self._fields)))
@@ -253,6 +631,194 @@ class CStruct(object):
     def __getitem__(self, item):  # to work with format strings
         return getattr(self, item)
 
+class TableRow(object):
+    """
+    View on an element of a StructTable; fields are decoded on access
+    """
+    __slots__ = ["table", "index"]
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getattr__(self, name):
+        try:
+            return self.table.get(self.index, name)
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, item):  # to work with format strings
+        return self.table.get(self.index, item)
+
+    def unpack(self):
+        """Return the element as a CStruct instance"""
+        return self.table.unpack(self.index)
+
+    def __str__(self):
+        return self.table.raw(self.index)
+
+    def __len__(self):
+        return self.table.itemsize
+
+    def __repr__(self):
+        return "<%s[%d]=%s>" % (self.table.cls.__name__, self.index,
+                                "/".join(repr(self[name])
+                                         for name in self.table.names))
+
+
+class StructTable(object):
+    """
+    Table of @count fixed size @cls elements, kept as raw bytes.
+    Columns are decoded on demand in an array (or a numpy array if numpy is
+    available); fields of sub structures are named 'field.subfield'.
+    """
+
+    def __init__(self, cls, s, off=0, count=0, parent_head=None, _sex=None,
+                 _wsize=None):
+        if _sex is None and _wsize is None:
+            if parent_head is not None:
+                _sex = parent_head._sex
+                _wsize = parent_head._wsize
+            else:
+                _sex = 0
+                _wsize = 32
+        self.cls = cls
+        self.parent_head = parent_head
+        self._sex = _sex
+        self._wsize = _wsize
+        if cls._packformat:
+            self.sex = cls._packformat
+        else:
+            self.sex = sex_types[_sex]
+        columns, self.itemsize = cls.get_table_layout(self.sex, _wsize)
+        self.names = [name for name, fmt, of in columns]
+        self._columns = dict((name, (fmt, of)) for name, fmt, of in columns)
+        self._getters = {}
+        self._records = None
+        end = off + count * self.itemsize
+        if not (0 <= off and 0 <= count and end <= len(s)):
+            raise RuntimeError("not enought data")
+        if isinstance(s, str) and off == 0 and end == len(s):
+            self._raw = s
+        else:
+            self._raw = get_bytes(s, off, end)
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __str__(self):
+        return self._raw
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield TableRow(self, i)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(self.count)
+            if step != 1:
+                return self.take(xrange(start, stop, step))
+            return StructTable(self.cls, self._raw, start * self.itemsize,
+                               max(stop - start, 0), self.parent_head,
+                               self._sex, self._wsize)
+        if item < 0:
+            item += self.count
+        if not 0 <= item < self.count:
+            raise IndexError('table index out of range')
+        return TableRow(self, item)
+
+    def get(self, index, name):
+        """Decode the field @name of the element @index"""
+        getter = self._getters.get(name)
+        if getter is None:
+            fmt, of = self._columns[name]
+            getter = struct.Struct(self.sex + fmt), of
+            self._getters[name] = getter
+        st, of = getter
+        return st.unpack_from(self._raw, index * self.itemsize + of)[0]
+
+    def raw(self, index):
+        """Return the raw bytes of the element @index"""
+        of = index * self.itemsize
+        return self._raw[of:of + self.itemsize]
+
+    def unpack(self, index):
+        """Return the element @index as a CStruct instance"""
+        return self.cls.unpack(self._raw, index * self.itemsize,
+                               self.parent_head, self._sex, self._wsize)
+
+    @property
+    def records(self):
+        """numpy structured array of the elements, or None without numpy"""
+        if numpy is None:
+            return None
+        if self._records is None:
+            formats, offsets = [], []
+            for name in self.names:
+                fmt, of = self._columns[name]
+                if fmt.endswith('s'):
+                    formats.append('S' + (fmt[:-1] or '1'))
+                else:
+                    formats.append(self.sex + fmt)
+                offsets.append(of)
+            dtype = numpy.dtype({'names': self.names, 'formats': formats,
+                                 'offsets': offsets,
+                                 'itemsize': self.itemsize})
+            if self.count:
+                self._records = numpy.frombuffer(self._raw, dtype,
+                                                 self.count)
+            else:
+                self._records = numpy.zeros(0, dtype)
+        return self._records
+
+    def column(self, name):
+        """
+        Return the values of the field @name of all the elements: a numpy
+        array if numpy is available, else an array (or a list for strings)
+        """
+        if numpy is not None:
+            return self.records[name]
+        fmt, of = self._columns[name]
+        size = struct.calcsize(self.sex + fmt)
+        tc = fmt2array.get(fmt)
+        if tc is not None and of % size == 0 and self.itemsize % size == 0:
+            values = array(tc, self._raw)
+            if self.sex != native_sex:
+                values.byteswap()
+            return values[of / size::self.itemsize / size]
+        fmt = "%dx%s%dx" % (of, fmt, self.itemsize - of - size)
+        values = struct.unpack(self.sex + fmt * self.count, self._raw)
+        if tc is not None:
+            return array(tc, values)
+        return list(values)
+
+    def argsort(self, name):
+        """Return the element indexes sorted by the field @name"""
+        if numpy is not None:
+            return self.records[name].argsort(kind='mergesort')
+        return sorted(xrange(self.count), key=self.column(name).__getitem__)
+
+    def take(self, indices):
+        """
+        Return a new table made of the elements @indices (with numpy, a
+        boolean mask is accepted too)
+        """
+        if numpy is not None and self.count:
+            items = numpy.frombuffer(self._raw, 'V%d' % self.itemsize,
+                                     self.count)
+            raw = items[numpy.asarray(indices)].tostring()
+        else:
+            size = self.itemsize
+            raw = "".join([self._raw[i * size:(i + 1) * size]
+                           for i in indices])
+        return StructTable(self.cls, raw, 0, len(raw) / self.itemsize,
+                           self.parent_head, self._sex, self._wsize)
+
+    def sort(self, name):
+        """Return a new table sorted by the field @name"""
+        return self.take(self.argsort(name))
+
 if __name__ == "__main__":
 
     """
@@ -323,6 +889,10 @@ if __name__ == "__main__":
 
     print all_cstructs
 
+    # fixed size fields are merged in a single step
+    assert len(c1.get_plan('<', 32)) == 1
+    assert len(c3.get_plan('<', 32)) == 4
+
     s1 = struct.pack('HHI', 1111, 2222, 333333333)
     c = c1.unpack(s1)
     print repr(c)
@@ -380,3 +950,40 @@ if __name__ == "__main__":
     c = c6.unpack(s9)
     print repr(c), repr(str(c))
     assert s9 == str(c)
+
+    # pack in a preallocated buffer
+    buf = bytearray(2 + len(s5) + len(s7) + len(s9))
+    of = 2
+    for cls, data in [(c3, s5), (c4, s7), (c6, s9)]:
+        c = cls.unpack(data)
+        assert c.packed_size() == len(data)
+        of += c.pack_into(buf, of)
+    assert of == len(buf)
+    assert str(buf) == "\x00" * 2 + s5 + s7 + s9
+
+    # table of c1 elements
+    s10 = "".join(struct.pack('<HHI', i, 10 - i, i * 3) for i in xrange(10))
+    t = c1.unpack_table(s10, 0, 10)
+    assert list(t.column("c1_field2")) == range(10, 0, -1)
+    assert list(t.sort("c1_field2").column("c1_field1")) == range(9, -1, -1)
+    assert t[4].c1_field3 == 12 and str(t[4]) == str(t[4].unpack())
+
+    # lazy unpack
+    c = c3.unpack(s5, lazy=True)
+    assert "b_value" not in c.__dict__ and c.b == [5555, 6666]
+    assert str(c) == s5
+    c = c6.unpack(s9, lazy=True)
+    assert c._lazy and str(c) == s9 and not c._lazy
+
+    # the length of a trailing custom field is only known once decoded
+    class c7(CStruct):
+        _fields = [("d", "u16"),
+                   ("e", (lambda c, s, of:c.gets(s, of),
+                          lambda c, value:c.sets(value))),
+                   ]
+        gets = c4.__dict__['gets']
+        sets = c4.__dict__['sets']
+    s11 = struct.pack('<H', 1) + "abc\x00"
+    assert c7.unpack_l(s11)[1] == len(s11)
+    c, l = c7.unpack_l(s11, lazy=True)
+    assert l is None and c.e == "abc"
@@ -1,16 +1,22 @@
 #! /usr/bin/env python
 
 from new_cstruct import CStruct
-from strpatchwork import StrPatchwork
+from strpatchwork import StrPatchwork, find_bytes, get_bytes, unpack_from
 import struct
 import logging
-from collections import defaultdict
+from array import array
+from bisect import bisect_left
+from itertools import izip
 log = logging.getLogger("pepy")
 console_handler = logging.StreamHandler()
 console_handler.setFormatter(logging.Formatter("%(levelname)-5s: %(message)s"))
 log.addHandler(console_handler)
 log.setLevel(logging.WARN)
 
+# native words of custom fields
+WORD = struct.Struct('H')
+DWORD = struct.Struct('I')
+
 
 class InvalidOffset(Exception):
     pass
@@ -132,6 +138,23 @@ class Shdr(CStruct):
                ("numberoflinenumbers", "u16"),
                ("flags", "u32")]
 
+    def __setattr__(self, name, value):
+        CStruct.__setattr__(self, name, value)
+        # keep the section lookup indexes of the PE in sync
+        if name in ("addr", "size", "offset", "rawsize"):
+            parent_head = self.__dict__.get("parent_head")
+            if hasattr(parent_head, "invalidate_section_index"):
+                parent_head.invalidate_section_index()
+
+    def __getattr__(self, name):
+        # the PE may load sections data on first access
+        if name == "data":
+            parent_head = self.__dict__.get("parent_head")
+            if getattr(parent_head, "_sections_pending", False):
+                parent_head.load_sections()
+                return self.data
+        return CStruct.__getattr__(self, name)
+
 
 class SHList(CStruct):
     _fields = [
@@ -225,7 +248,9 @@ class SHList(CStruct):
         return len(self.shlist)
 
     def append(self, s):
+        s.parent_head = self.parent_head
         self.shlist.append(s)
+        self.parent_head.invalidate_section_index()
 
 
 class Rva(CStruct):
@@ -244,7 +269,7 @@ class DescName(CStruct):
                ]
 
     def gets(self, s, of):
-        name = s[of:s.find('\x00', of)]
+        name = get_bytes(s, of, find_bytes(s, '\x00', of))
         return name, of + len(name) + 1
 
     def sets(self, value):
@@ -393,6 +418,7 @@ class DirImport(CStruct):
         return l
 
     def set_rva(self, rva, size=None):
+        self.invalidate_index()
         self.parent_head.NThdr.optentries[DIRECTORY_ENTRY_IMPORT].rva = rva
         if not size:
             self.parent_head.NThdr.optentries[
@@ -550,34 +576,53 @@ class DirImport(CStruct):
         else:
             for d in new_impdesc:
                 self.impdesc.append(d)
+        self.invalidate_index()
+
+    def invalidate_index(self):
+        """Drop the lookup indexes; they are rebuilt on the next lookup.
+        Needed after modifying the descriptors by hand"""
+        self._index = None
+
+    def get_index(self):
+        """
+        Return the (by_name, by_rva) indexes of the imports:
+        (dll name in lower case, function name or ordinal) -> iat rva, and
+        iat rva -> (dll name, function name or ordinal)
+        """
+        index = getattr(self, '_index', None)
+        if index is not None and index[0] is self.impdesc:
+            return index[1:]
+        mask_ptr = (1 << (self.parent_head._wsize - 1)) - 1
+        ptr_size = self.parent_head._wsize / 8
+        by_name, by_rva = {}, {}
+        for d in self.impdesc or []:
+            if d.firstthunk is None:
+                continue
+            dllname = d.dlldescname.name
+            tmp_thunk = d.firstthunks
+            try:
+                if (d.originalfirstthunk and
+                        self.parent_head.rva2off(d.originalfirstthunk)):
+                    tmp_thunk = d.originalfirstthunks
+            except InvalidOffset:
+                pass
+            for j, imp in enumerate(d.impbynames):
+                rva = d.firstthunk + j * ptr_size
+                if isinstance(imp, ImportByName):
+                    by_name.setdefault((dllname.lower(), imp.name), rva)
+                    by_rva.setdefault(rva, (dllname, imp.name))
+                    continue
+                if tmp_thunk is not None and j < len(tmp_thunk):
+                    ordinal = tmp_thunk[j].rva & mask_ptr
+                    by_name.setdefault((dllname.lower(), ordinal), rva)
+                by_rva.setdefault(rva, (dllname, imp))
+        self._index = (self.impdesc, by_name, by_rva)
+        return by_name, by_rva
 
     def get_funcrva(self, dllname, funcname):
-        if self.parent_head._wsize == 32:
-            mask_ptr = 0x80000000 - 1
-        elif self.parent_head._wsize == 64:
-            mask_ptr = 0x8000000000000000L - 1
-
-        for i, d in enumerate(self.impdesc):
-            if d.dlldescname.name.lower() != dllname.lower():
-                continue
-            if d.originalfirstthunk and self.parent_head.rva2off(d.originalfirstthunk):
-                tmp_thunk = d.originalfirstthunks
-            elif d.firstthunk:
-                tmp_thunk = d.firstthunks
-            else:
-                raise RuntimeError("No thunk!")
-            if type(funcname) is str:
-                for j, imp in enumerate(d.impbynames):
-                    if isinstance(imp, ImportByName):
-                        if funcname == imp.name:
-                            return d.firstthunk + j * self.parent_head._wsize / 8
-            elif type(funcname) in (int, long):
-                for j, imp in enumerate(d.impbynames):
-                    if not isinstance(imp, ImportByName):
-                        if tmp_thunk[j].rva & mask_ptr == funcname:
-                            return d.firstthunk + j * self.parent_head._wsize / 8
-            else:
-                raise ValueError('Unknown: %s %s' % (dllname, funcname))
+        if not type(funcname) in (str, int, long):
+            raise ValueError('Unknown: %s %s' % (dllname, funcname))
+        return self.get_index()[0].get((dllname.lower(), funcname))
 
     def get_funcvirt(self, dllname, funcname):
         rva = self.get_funcrva(dllname, funcname)
@@ -585,6 +630,14 @@ class DirImport(CStruct):
             return
         return self.parent_head.rva2virt(rva)
 
+    def get_funcbyrva(self, rva):
+        """Return the (dll name, function name or ordinal) imported through
+        the iat entry at @rva, or None"""
+        return self.get_index()[1].get(rva)
+
+    def get_funcbyvirt(self, ad):
+        return self.get_funcbyrva(self.parent_head.virt2rva(ad))
+
 
 class ExpDesc_e(CStruct):
     _fields = [("characteristics", "u32"),
@@ -750,6 +803,7 @@ class DirExport(CStruct):
                                            None,
                                            Ordinal)
         self.expdesc.base = 1
+        self.invalidate_index()
 
     def add_name(self, name, rva=0xdeadc0fe):
         if self.expdesc is None:
@@ -781,17 +835,45 @@ class DirExport(CStruct):
         self.f_nameordinals.insert(index, wordinal)
         self.expdesc.numberofnames += 1
         self.expdesc.numberoffunctions += 1
+        self.invalidate_index()
+
+    def invalidate_index(self):
+        """Drop the lookup indexes; they are rebuilt on the next lookup.
+        Needed after modifying the exports by hand"""
+        self._index = None
+
+    def get_index(self):
+        """
+        Return the (by_name, by_rva) indexes of the exports: function name
+        -> rva, and rva -> function name, or ordinal if unnamed
+        """
+        index = getattr(self, '_index', None)
+        if index is not None and index[0] is self.expdesc:
+            return index[1:]
+        by_name, by_rva = {}, {}
+        if self.expdesc is not None:
+            for i, f in enumerate(self.f_names):
+                o = self.f_nameordinals[i].ordinal
+                rva = self.f_address[o].rva
+                by_name.setdefault(f.name.name, rva)
+                by_rva.setdefault(rva, f.name.name)
+            for i, f in enumerate(self.f_address):
+                if f.rva:
+                    by_rva.setdefault(f.rva, i + self.expdesc.base)
+        self._index = (self.expdesc, by_name, by_rva)
+        return by_name, by_rva
 
     def get_funcrva(self, f_str):
+        """Return the rva of the function exported as @f_str, a name or an
+        ordinal, or None"""
         if self.expdesc is None:
             return None
-        for i, f in enumerate(self.f_names):
-            if f_str != f.name.name:
-                continue
-            o = self.f_nameordinals[i].ordinal
-            rva = self.f_address[o].rva
-            return rva
-        return None
+        if type(f_str) in (int, long):
+            i = f_str - self.expdesc.base
+            if 0 <= i < len(self.f_address) and self.f_address[i].rva:
+                return self.f_address[i].rva
+            return None
+        return self.get_index()[0].get(f_str)
 
     def get_funcvirt(self, f):
         rva = self.get_funcrva(f)
@@ -799,6 +881,14 @@ class DirExport(CStruct):
             return
         return self.parent_head.rva2virt(rva)
 
+    def get_funcbyrva(self, rva):
+        """Return the name, or ordinal if unnamed, of the function exported
+        at @rva, or None"""
+        return self.get_index()[1].get(rva)
+
+    def get_funcbyvirt(self, ad):
+        return self.get_funcbyrva(self.parent_head.virt2rva(ad))
+
 
 class Delaydesc_e(CStruct):
     _fields = [("attrs", "u32"),
@@ -912,6 +1002,7 @@ class DirDelay(CStruct):
         return l
 
     def set_rva(self, rva, size=None):
+        self.invalidate_index()
         self.parent_head.NThdr.optentries[
             DIRECTORY_ENTRY_DELAY_IMPORT].rva = rva
         if not size:
@@ -1050,32 +1141,57 @@ class DirDelay(CStruct):
         else:
             for d in new_delaydesc:
                 self.delaydesc.append(d)
-
-    def get_funcrva(self, f):
-        for i, d in enumerate(self.delaydesc):
+        self.invalidate_index()
+
+    def invalidate_index(self):
+        """Drop the lookup indexes; they are rebuilt on the next lookup.
+        Needed after modifying the descriptors by hand"""
+        self._index = None
+
+    def get_index(self):
+        """
+        Return the (by_name, by_rva) indexes of the delayed imports:
+        function name or ordinal -> iat rva, and iat rva -> (dll name,
+        function name or ordinal)
+        """
+        index = getattr(self, '_index', None)
+        if index is not None and index[0] is self.delaydesc:
+            return index[1:]
+        by_name, by_rva = {}, {}
+        for d in self.delaydesc or []:
+            if not d.firstthunk:
+                continue
             isfromva = (d.attrs & 1) == 0
             if isfromva:
                 isfromva = lambda x: self.parent_head.virt2rva(x)
             else:
                 isfromva = lambda x: x
-            if d.originalfirstthunk and self.parent_head.rva2off(isfromva(d.originalfirstthunk)):
-                tmp_thunk = d.originalfirstthunks
-            elif d.firstthunk:
-                tmp_thunk = d.firstthunks
-            else:
-                raise RuntimeError("No thunk!")
-            if type(f) is str:
-                for j, imp in enumerate(d.impbynames):
-                    if isinstance(imp, ImportByName):
-                        if f == imp.name:
-                            return isfromva(d.firstthunk) + j * 4
-            elif type(f) in (int, long):
-                for j, imp in enumerate(d.impbynames):
-                    if not isinstance(imp, ImportByName):
-                        if isfromva(tmp_thunk[j].rva & 0x7FFFFFFF) == f:
-                            return isfromva(d.firstthunk) + j * 4
-            else:
-                raise ValueError('unknown func tpye %s' % str(f))
+            dllname = d.dlldescname.name
+            tmp_thunk = d.firstthunks
+            try:
+                if (d.originalfirstthunk and self.parent_head.rva2off(
+                        isfromva(d.originalfirstthunk))):
+                    tmp_thunk = d.originalfirstthunks
+            except InvalidOffset:
+                pass
+            firstthunk = isfromva(d.firstthunk)
+            for j, imp in enumerate(d.impbynames):
+                rva = firstthunk + j * 4
+                if isinstance(imp, ImportByName):
+                    by_name.setdefault(imp.name, rva)
+                    by_rva.setdefault(rva, (dllname, imp.name))
+                    continue
+                if tmp_thunk is not None and j < len(tmp_thunk):
+                    by_name.setdefault(
+                        isfromva(tmp_thunk[j].rva & 0x7FFFFFFF), rva)
+                by_rva.setdefault(rva, (dllname, imp))
+        self._index = (self.delaydesc, by_name, by_rva)
+        return by_name, by_rva
+
+    def get_funcrva(self, f):
+        if not type(f) in (str, int, long):
+            raise ValueError('unknown func tpye %s' % str(f))
+        return self.get_index()[0].get(f)
 
     def get_funcvirt(self, f):
         rva = self.get_funcrva(f)
@@ -1083,6 +1199,14 @@ class DirDelay(CStruct):
             return
         return self.parent_head.rva2virt(rva)
 
+    def get_funcbyrva(self, rva):
+        """Return the (dll name, function name or ordinal) imported through
+        the delayed iat entry at @rva, or None"""
+        return self.get_index()[1].get(rva)
+
+    def get_funcbyvirt(self, ad):
+        return self.get_funcbyrva(self.parent_head.virt2rva(ad))
+
 
 class Rel(CStruct):
     _fields = [("rva", "u32"),
@@ -1091,11 +1215,14 @@ class Rel(CStruct):
 
 
 class Reloc(CStruct):
+    _compact = True
+    # raw (type << 12 | offset) words, for StructTable
+    _table_fields = [("rel", "u16")]
     _fields = [("rel", (lambda c, s, of:c.gete(s, of),
                         lambda c, value:c.sete(value)))]
 
     def gete(self, s, of):
-        rel = struct.unpack('H', s[of:of + 2])[0]
+        rel = unpack_from(WORD, s, of)[0]
         return (rel >> 12, rel & 0xfff), of + 2
 
     def sete(self, value):
@@ -1105,6 +1232,79 @@ class Reloc(CStruct):
         return '<%d %d>' % (self.rel[0], self.rel[1])
 
 
+class RelocTable(object):
+    """
+    Base relocations, kept sorted by rva in compact arrays; built from
+    (rva, type) fixups, at most one per rva, and encoded in blocks of
+    Reloc words in one pass.
+    """
+
+    def __init__(self, fixups=()):
+        self.rvas = array('I')
+        self.types = array('B')
+        self.update(fixups)
+
+    def set_fixups(self, fixups):
+        """Replace the content by the {rva: type} dict @fixups"""
+        rvas = sorted(fixups)
+        self.rvas = array('I', rvas)
+        self.types = array('B', [fixups[rva] for rva in rvas])
+
+    def update(self, fixups):
+        """Add the (rva, type) @fixups; a relocation already at the same
+        rva is replaced"""
+        merged = dict(izip(self.rvas, self.types))
+        for rva, t in fixups:
+            if not 0 < t < 16:
+                raise ValueError('bad relocation type %r' % t)
+            merged[rva] = t
+        self.set_fixups(merged)
+
+    def add(self, rvas, rtype=3):
+        """Add relocations of type @rtype at each of @rvas"""
+        self.update((rva, rtype) for rva in rvas)
+
+    def remove(self, rvas):
+        """Remove the relocations at each of @rvas, if any"""
+        rvas = set(rvas)
+        self.set_fixups(dict((rva, t) for rva, t in self
+                             if rva not in rvas))
+
+    def __len__(self):
+        return len(self.rvas)
+
+    def __iter__(self):
+        return izip(self.rvas, self.types)
+
+    def __contains__(self, rva):
+        i = bisect_left(self.rvas, rva)
+        return i < len(self.rvas) and self.rvas[i] == rva
+
+    def blocks(self):
+        """Yield the (page rva, array of Reloc words) of each block; the
+        blocks are padded to a 32 bit boundary with an absolute relocation"""
+        rvas, types = self.rvas, self.types
+        i = 0
+        while i < len(rvas):
+            page = rvas[i] & 0xFFFFF000
+            j = bisect_left(rvas, page + 0x1000, i)
+            words = array('H', [(t << 12) | (rva & 0xFFF) for rva, t in
+                                izip(rvas[i:j], types[i:j])])
+            words.extend([0] * (len(words) & 1))
+            yield page, words
+            i = j
+
+    def __str__(self):
+        rep = []
+        for page, words in self.blocks():
+            rep.append(struct.pack('II', page, 8 + 2 * len(words)))
+            rep.append(words.tostring())
+        return "".join(rep)
+
+    def __repr__(self):
+        return "<%s %d relocs>" % (self.__class__.__name__, len(self))
+
+
 class DirReloc(CStruct):
     _fields = [("reldesc", (lambda c, s, of:c.gete(s, of),
                             lambda c, value:c.sete(value)))]
@@ -1147,6 +1347,20 @@ class DirReloc(CStruct):
             rep.append(str(n.rels))
         return "".join(rep)
 
+    def fixups(self):
+        """Return the (rva, type) of the relocations, in order, without the
+        IMAGE_REL_BASED_ABSOLUTE padding ones"""
+        out = []
+        if self.reldesc is None:
+            return out
+        for rel in self.reldesc:
+            rva = rel.rva
+            for reloc in rel.rels:
+                t, off = reloc.rel
+                if t != IMAGE_REL_BASED_ABSOLUTE:
+                    out.append((rva + off, t))
+        return out
+
     def set_rva(self, rva, size=None):
         if self.reldesc is None:
             return
@@ -1198,61 +1412,45 @@ class DirReloc(CStruct):
             rep.append(l)
         return "\n".join(rep)
 
-    def add_reloc(self, rels, rtype=3, patchrel=True):
+    def get_table(self):
+        """Return the RelocTable of the relocations"""
+        return RelocTable(self.fixups())
+
+    def set_table(self, table, patchrel=True):
+        """Replace the relocations by the RelocTable @table; blocks of pages
+        not relocated before get the @patchrel flag"""
         dirrel = self.parent_head.NThdr.optentries[DIRECTORY_ENTRY_BASERELOC]
+        patched = {}
+        for rel in self.reldesc or []:
+            patched[rel.rva] = getattr(rel, 'patchrel', False)
+        reldesc = []
+        for page, words in table.blocks():
+            rel = Rel(self.parent_head)
+            rel.rva = page
+            rel.size = 8 + 2 * len(words)
+            rel.rels = struct_array(self, words.tostring(), 0, Reloc,
+                                    len(words))
+            rel.patchrel = patched.get(page, patchrel)
+            reldesc.append(rel)
+        self.reldesc = reldesc
+        dirrel.size = len(self)
+
+    def add_reloc(self, rels, rtype=3, patchrel=True):
+        """Add relocations of type @rtype at the rvas @rels, merged in the
+        blocks of their pages"""
         if not rels:
             return
-        rels.sort()
-        all_base_ad = set([x & 0xFFFFF000 for x in rels])
-        all_base_ad = list(all_base_ad)
-        all_base_ad.sort()
-        rels_by_base = defaultdict(list)
-        while rels:
-            r = rels.pop()
-            if r >= all_base_ad[-1]:
-                rels_by_base[all_base_ad[-1]].append(r)
-            else:
-                all_base_ad.pop()
-                rels_by_base[all_base_ad[-1]].append(r)
-        rels_by_base = [x for x in rels_by_base.items()]
-        rels_by_base.sort()
-        for o_init, rels in rels_by_base:
-            # o_init = rels[0]&0xFFFFF000
-            offsets = struct_array(self, None, None, Reloc, 0)
-            for o in rels:
-                if (o & 0xFFFFF000) != o_init:
-                    raise "relocs must be in same range"
-                r = Reloc(self.parent_head)
-                r.rel = (rtype, o - o_init)
-                offsets.append(r)
-            while len(offsets) & 3:
-                r = Reloc(self.parent_head)
-                r.rel = (0, 0)
-                offsets.append(r)
-            reldesc = Rel(self.parent_head)  # Reloc(self.parent_head)
-            reldesc.rva = o_init
-            reldesc.size = (len(offsets) * 2 + 8)
-            reldesc.rels = offsets
-            reldesc.patchrel = patchrel
-            # if self.reldesc is None:
-            #    self.reldesc = []
-            self.reldesc.append(reldesc)
-            dirrel.size += reldesc.size
+        table = self.get_table()
+        table.add(rels, rtype)
+        self.set_table(table, patchrel)
 
     def del_reloc(self, taboffset):
+        """Remove the relocations at the rvas @taboffset"""
         if self.reldesc is None:
             return
-        for rel in self.reldesc:
-            of1 = rel.rva
-            i = 0
-            while i < len(rel.rels):
-                r = rel.rels[i]
-                if r.rel[0] != 0 and r.rel[1] + of1 in taboffset:
-                    print 'del reloc', hex(r.rel[1] + of1)
-                    del rel.rels[i]
-                    rel.size -= Reloc._size
-                else:
-                    i += 1
+        table = self.get_table()
+        table.remove(taboffset)
+        self.set_table(table)
 
 
 class DirRes(CStruct):
@@ -1295,51 +1493,77 @@ class DirRes(CStruct):
                                           of,
                                           ResEntry,
                                           nbr)
-        dir_todo = {of_orig: resdesc}
-        dir_done = {}
-        xx = 0
-        cpt = 0
+        # subdirectories and data are decoded on access, by load_entry
+        self._res_s = s
+        self._res_dirs = {of_orig: resdesc}
+        self.attach_entries(resdesc)
+        return resdesc, of
+
+    def attach_entries(self, my_dir):
+        """Make the subdir and data of the entries of @my_dir lazy"""
+        for e in my_dir.resentries:
+            e._res = self
+
+    def load_entry(self, e):
+        """Decode the subdir or data of the resource entry @e; the data is
+        a view of the image, copied only when modified"""
+        s = self._res_s
+        del e._res
+        e.data = None
+        of = e.offsettosubdir
+        if not of:
+            # data dir
+            of = e.offsettodata
+            if not 0 <= of < len(s):
+                log.warn('bad resrouce entry')
+                return
+            data = ResDataEntry.unpack(s,
+                                       of,
+                                       self.parent_head)
+            of = data.offsettodata
+            if hasattr(s, 'view'):
+                data.s = s.view(of, min(of + data.size, len(s)))
+            else:
+                data.s = StrPatchwork(s[of:of + data.size])
+            e.data = data
+            return
+        # subdir
+        if of in self._res_dirs:
+            log.warn('warning recusif subdir')
+            return
+        if not 0 <= of < len(self.parent_head.img_rva):
+            log.warn('bad resrouce entry')
+            return
+        subdir, l = ResDesc_e.unpack_l(s,
+                                       of,
+                                       self.parent_head)
+        nbr = subdir.numberofnamedentries + subdir.numberofidentries
+        try:
+            subdir.resentries = struct_array(self, s,
+                                             of + l,
+                                             ResEntry,
+                                             nbr)
+        except RuntimeError:
+            log.warn('bad resrouce entry')
+            return
+        self._res_dirs[of] = subdir
+        self.attach_entries(subdir)
+        e.subdir = subdir
+
+    def load_tree(self):
+        """Decode the subdirs and data not accessed yet"""
+        dir_todo = [self.resdesc]
+        seen = set()
         while dir_todo:
-            of, my_dir = dir_todo.popitem()
-            dir_done[of] = my_dir
+            my_dir = dir_todo.pop()
+            if id(my_dir) in seen:
+                continue
+            seen.add(id(my_dir))
             for e in my_dir.resentries:
-                of = e.offsettosubdir
-                if not of:
-                    # data dir
-                    of = e.offsettodata
-                    if not 0 <= of < len(s):
-                        log.warn('bad resrouce entry')
-                        continue
-                    data = ResDataEntry.unpack(s,
-                                               of,
-                                               self.parent_head)
-                    of = data.offsettodata
-                    data.s = StrPatchwork(s[of:of + data.size])
-                    e.data = data
-                    continue
-                # subdir
-                if of in dir_done:
-                    log.warn('warning recusif subdir')
-                    continue
-                if not 0 <= of < len(self.parent_head.img_rva):
-                    log.warn('bad resrouce entry')
-                    continue
-                subdir, l = ResDesc_e.unpack_l(s,
-                                               of,
-                                               self.parent_head)
-                nbr = subdir.numberofnamedentries + subdir.numberofidentries
-                try:
-                    subdir.resentries = struct_array(self, s,
-                                                     of + l,
-                                                     ResEntry,
-                                                     nbr)
-                except RuntimeError:
-                    log.warn('bad resrouce entry')
-                    continue
-
-                e.subdir = subdir
-                dir_todo[of] = e.subdir
-        return resdesc, of
+                if "_res" in e.__dict__:
+                    self.load_entry(e)
+                if e.__dict__.get("subdir") is not None:
+                    dir_todo.append(e.subdir)
 
     def build_content(self, c):
         if self.resdesc is None:
@@ -1370,21 +1594,19 @@ class DirRes(CStruct):
             return l
         dir_todo = [self.resdesc]
         dir_done = []
+        seen = set([id(self.resdesc)])
         while dir_todo:
             my_dir = dir_todo.pop()
-            if not my_dir in dir_done:
-                dir_done.append(my_dir)
-            else:
-                raise 'recursif dir'
+            dir_done.append(my_dir)
             l += len(my_dir)
             l += len(my_dir.resentries) * 8  # ResEntry size
             for e in my_dir.resentries:
                 if not e.offsettosubdir:
                     continue
-                if not e.subdir in dir_todo:
-                    dir_todo.append(e.subdir)
-                else:
+                if id(e.subdir) in seen:
                     raise RuntimeError("recursive dir")
+                seen.add(id(e.subdir))
+                dir_todo.append(e.subdir)
 
         dir_todo = dir_done
         while dir_todo:
@@ -1404,6 +1626,8 @@ class DirRes(CStruct):
     def set_rva(self, rva, size=None):
         if self.resdesc is None:
             return
+        # entries are decoded relatively to the current directory rva
+        self.load_tree()
         self.parent_head.NThdr.optentries[DIRECTORY_ENTRY_RESOURCE].rva = rva
         if not size:
             self.parent_head.NThdr.optentries[
@@ -1413,6 +1637,7 @@ class DirRes(CStruct):
                 DIRECTORY_ENTRY_RESOURCE].size = size
         dir_todo = [self.resdesc]
         dir_done = {}
+        seen = set([id(self.resdesc)])
         while dir_todo:
             my_dir = dir_todo.pop()
             dir_done[rva] = my_dir
@@ -1421,10 +1646,10 @@ class DirRes(CStruct):
             for e in my_dir.resentries:
                 if not e.offsettosubdir:
                     continue
-                if not e.subdir in dir_todo:
-                    dir_todo.append(e.subdir)
-                else:
+                if id(e.subdir) in seen:
                     raise RuntimeError("recursive dir")
+                seen.add(id(e.subdir))
+                dir_todo.append(e.subdir)
         dir_todo = dir_done
         dir_inv = dict(map(lambda x: (x[1], x[0]), dir_todo.items()))
         while dir_todo:
@@ -1435,13 +1660,15 @@ class DirRes(CStruct):
                     rva += len(e.name_s)
                 of1 = e.offsettosubdir
                 if not of1:
+                    # decode the data before moving it
+                    data = e.data
                     e.offsettodata = rva
                     rva += 4 * 4  # ResDataEntry size
                     # XXX menu rsrc must be even aligned?
                     if rva % 2:
                         rva += 1
-                    e.data.offsettodata = rva
-                    rva += e.data.size
+                    data.offsettodata = rva
+                    rva += data.size
                     continue
                 e.offsettosubdir = dir_inv[e.subdir]
 
@@ -1494,7 +1721,7 @@ class SUnicode(CStruct):
                ]
 
     def gets(self, s, of):
-        v = s[of:of + self.length * 2]
+        v = get_bytes(s, of, of + self.length * 2)
         return v, of + self.length
 
     def sets(self, value):
@@ -1509,9 +1736,8 @@ class ResEntry(CStruct):
                ]
 
     def getn(self, s, of):
-        self.data = None
         # of = self.parent_head.rva2off(of)
-        name = struct.unpack('I', s[of:of + 4])[0]
+        name = unpack_from(DWORD, s, of)[0]
         self.name_s = None
         if name & 0x80000000:
             name = (name & 0x7FFFFFFF) + self.parent_head.NThdr.optentries[
@@ -1533,7 +1759,7 @@ class ResEntry(CStruct):
 
     def geto(self, s, of):
         self.offsettosubdir = None
-        offsettodata_o = struct.unpack('I', s[of:of + 4])[0]
+        offsettodata_o = unpack_from(DWORD, s, of)[0]
         offsettodata = (offsettodata_o & 0x7FFFFFFF) + self.parent_head.NThdr.optentries[
             DIRECTORY_ENTRY_RESOURCE].rva  # XXX res rva??
         if offsettodata_o & 0x80000000:
@@ -1562,6 +1788,16 @@ class ResEntry(CStruct):
             offsettodata = "data: %x" % self.offsettodata
         return "<%s %s>" % (nameid, offsettodata)
 
+    def __getattr__(self, name):
+        # subdir and data of parsed entries are decoded on first access
+        if name in ("subdir", "data"):
+            res = self.__dict__.get("_res")
+            if res is not None:
+                res.load_entry(self)
+                if name in self.__dict__:
+                    return self.__dict__[name]
+        return CStruct.__getattr__(self, name)
+
 
 class ResDataEntry(CStruct):
     _fields = [("offsettodata", "u32"),
@@ -1596,6 +1832,14 @@ DIRECTORY_ENTRY_COM_DESCRIPTOR = 14
 DIRECTORY_ENTRY_RESERVED = 15
 
 
+IMAGE_REL_BASED_ABSOLUTE = 0
+IMAGE_REL_BASED_HIGH = 1
+IMAGE_REL_BASED_LOW = 2
+IMAGE_REL_BASED_HIGHLOW = 3
+IMAGE_REL_BASED_HIGHADJ = 4
+IMAGE_REL_BASED_DIR64 = 10
+
+
 RT_CURSOR = 1
 RT_BITMAP = 2
 RT_ICON = 3
@@ -1,16 +1,65 @@
 #! /usr/bin/env python
 
 import struct
-import array
 import pe
-from strpatchwork import StrPatchwork
+from checksum import Checksum, pe_checksum
+from intervals import AddrIndex
+from scanner import Scanner, contiguous_runs
+from strpatchwork import StrPatchwork, LayeredView, get_bytes, read_file
 import logging
 from collections import defaultdict
+from cStringIO import StringIO
 log = logging.getLogger("peparse")
 console_handler = logging.StreamHandler()
 console_handler.setFormatter(logging.Formatter("%(levelname)-5s: %(message)s"))
 log.addHandler(console_handler)
 log.setLevel(logging.WARN)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# relocation type: (width, shift of the image delta)
+reloc_types = {
+    pe.IMAGE_REL_BASED_HIGH: (2, 16),
+    pe.IMAGE_REL_BASED_LOW: (2, 0),
+    pe.IMAGE_REL_BASED_HIGHLOW: (4, 0),
+    pe.IMAGE_REL_BASED_DIR64: (8, 0),
+}
+reloc_formats = {2: struct.Struct('<H'), 4: struct.Struct('<I'),
+                 8: struct.Struct('<Q')}
+
+
+def apply_relocs(buf, fixups, delta):
+    """
+    Apply the relocations @fixups, (offset, type) couples, to the bytearray
+    @buf for an image moved by @delta; with numpy, values are gathered and
+    scattered per type if the fixups do not overlap
+    """
+    spans = sorted((off, off + reloc_types[t][0]) for off, t in fixups)
+    overlap = any(spans[i][1] > spans[i + 1][0]
+                  for i in xrange(len(spans) - 1))
+    if numpy is None or overlap:
+        for off, t in fixups:
+            width, shift = reloc_types[t]
+            fmt = reloc_formats[width]
+            mask = (1 << (8 * width)) - 1
+            v = fmt.unpack_from(buf, off)[0]
+            fmt.pack_into(buf, off, (v + (delta >> shift)) & mask)
+        return
+    by_type = {}
+    for off, t in fixups:
+        by_type.setdefault(t, []).append(off)
+    data = numpy.frombuffer(buf, numpy.uint8)
+    for t, offsets in by_type.items():
+        width, shift = reloc_types[t]
+        dtype = numpy.dtype('<u%d' % width)
+        mask = (1 << (8 * width)) - 1
+        index = (numpy.array(offsets, numpy.int64)[:, None] +
+                 numpy.arange(width))
+        values = data[index].view(dtype)[:, 0]
+        values += dtype.type((delta >> shift) & mask)
+        data[index] = values.view(numpy.uint8).reshape(-1, width)
 
 
 class ContentManager(object):
@@ -27,6 +76,43 @@ class ContentManager(object):
         self.__set__(owner, None)
 
 
+class DirectoryManager(object):
+    """PE directory attribute, parsed on first access if the parse profile
+    left it out"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, owner, x):
+        if owner is None:
+            return self
+        if self.name in owner._pending_dirs:
+            owner.parse_directory(self.name)
+        try:
+            return owner.__dict__['_' + self.name]
+        except KeyError:
+            raise AttributeError(self.name)
+
+    def __set__(self, owner, value):
+        owner._pending_dirs.discard(self.name)
+        owner.__dict__['_' + self.name] = value
+
+
+class ContentLayers(object):
+    """Content writes c[offset] = data of build_content, kept as
+    (offset, size, data) layers instead of being copied"""
+
+    def __init__(self):
+        self.layers = []
+
+    def __setitem__(self, item, data):
+        if data is None:
+            return
+        if type(item) is slice:
+            item = item.start
+        self.layers.append((item, len(data), data))
+
+
 class ContectRva(object):
 
     def __init__(self, parent):
@@ -117,13 +203,16 @@ class ContectRva(object):
         for s, n_item in rva_items:
             i = slice(off, n_item.stop + off - n_item.start, n_item.step)
             data_slice = data.__getitem__(i)
-            s.data.__setitem__(n_item, data_slice)
             off = i.stop
-            # XXX test patch content
-            file_off = self.parent.rva2off(s.addr + n_item.start)
-            if self.parent.content:
-                self.parent.content = self.parent.content[
-                    :file_off] + data_slice + self.parent.content[file_off + len(data_slice):]
+            if s is None:
+                # pe header
+                file_off = n_item.start
+            else:
+                s.data.__setitem__(n_item, data_slice)
+                file_off = self.parent.rva2off(s.addr + n_item.start)
+                # bytes past rawsize are not in the file
+                data_slice = data_slice[:max(0, s.rawsize - n_item.start)]
+            self.parent.patch_content(file_off, data_slice)
         return
 
     def __getitem__(self, item):
@@ -245,20 +334,72 @@ class ContentVirtual:
     def is_addr_in(self, ad):
         return self.parent.is_in_virt_address(ad)
 
+    def mapped_runs(self):
+        """Return the (virtual address, data) runs of contiguous memory of
+        the mapped image: the headers and the sections, zero filled up to
+        their virtual size rounded to the section alignment"""
+        p = self.parent
+        align = max(p.NThdr.sectionalignment, 1)
+        size = p.NThdr.sizeofheaders
+        regions = [(0, (size + align - 1) / align * align,
+                    p.content.view(0, size))]
+        for s in p.SHList:
+            size = max(s.size, len(s.data))
+            regions.append((s.addr, (size + align - 1) / align * align,
+                            s.data))
+        return [(p.rva2virt(rva), data)
+                for rva, data in contiguous_runs(regions)]
+
+    def scan(self, patterns):
+        """Return the sorted (virtual address, pattern id) hits of
+        @patterns, a Scanner or its patterns, in one pass over the mapped
+        image; matches may span sections"""
+        if not isinstance(patterns, Scanner):
+            patterns = Scanner(patterns)
+        return patterns.scan(self.mapped_runs())
+
 # PE object
 
 
 class PE(object):
     content = ContentManager()
+    DirImport = DirectoryManager('DirImport')
+    DirExport = DirectoryManager('DirExport')
+    DirDelay = DirectoryManager('DirDelay')
+    DirReloc = DirectoryManager('DirReloc')
+    DirRes = DirectoryManager('DirRes')
+
+    # parse profile item: directory attribute, class, optentries index
+    directories = {
+        'imports': ('DirImport', pe.DirImport, pe.DIRECTORY_ENTRY_IMPORT),
+        'exports': ('DirExport', pe.DirExport, pe.DIRECTORY_ENTRY_EXPORT),
+        'delay': ('DirDelay', pe.DirDelay, pe.DIRECTORY_ENTRY_DELAY_IMPORT),
+        'reloc': ('DirReloc', pe.DirReloc, pe.DIRECTORY_ENTRY_BASERELOC),
+        'resources': ('DirRes', pe.DirRes, pe.DIRECTORY_ENTRY_RESOURCE),
+    }
+    parse_all = ('headers', 'sections', 'imports', 'exports', 'delay',
+                 'reloc', 'resources')
 
     def __init__(self, pestr=None,
                  loadfrommem=False,
                  parse_resources=True,
                  parse_delay=True,
                  parse_reloc=True,
-                 wsize=32):
+                 wsize=32,
+                 parse=None):
+        """
+        @pestr: file content, None to build a new PE
+        @parse: parse profile, items of PE.parse_all; the headers (and
+        section table) are always parsed, sections data and directories
+        left out are parsed on first access
+        @parse_resources, @parse_delay, @parse_reloc: if False, the
+        directory is left empty instead
+        """
         self._rva = ContectRva(self)
         self._virt = ContentVirtual(self)
+        self._section_index = None
+        self._pending_dirs = set()
+        self._sections_pending = False
         self.img_rva = StrPatchwork()
         if pestr == None:
             self._content = StrPatchwork()
@@ -343,17 +484,50 @@ class PE(object):
             self.loadfrommem = loadfrommem
             self.parse_content(parse_resources=parse_resources,
                                parse_delay=parse_delay,
-                               parse_reloc=parse_reloc)
+                               parse_reloc=parse_reloc,
+                               parse=parse)
+
+    @classmethod
+    def from_file(cls, path, mmap=True, **kargs):
+        """Parse the file @path; if @mmap, it is memory mapped and only
+        copied when modified, and the file must not be truncated or
+        overwritten while the PE is in use. @kargs are given to the
+        constructor"""
+        return cls(read_file(path, mmap), **kargs)
 
     def isPE(self):
         if self.NTsig is None:
             return False
         return self.NTsig.signature == 0x4550
 
+    def get_img_rva(self):
+        if self._sections_pending:
+            self.load_sections()
+        return self._img_rva
+
+    def set_img_rva(self, img_rva):
+        self._img_rva = img_rva
+    img_rva = property(get_img_rva, set_img_rva)
+
     def parse_content(self,
                       parse_resources=True,
                       parse_delay=True,
-                      parse_reloc=True):
+                      parse_reloc=True,
+                      parse=None):
+        if parse is None:
+            parse = self.parse_all
+        unknown = set(parse).difference(self.parse_all)
+        if unknown:
+            raise ValueError('unknown parse profile items %r' % sorted(unknown))
+        disabled = set()
+        if not parse_resources:
+            disabled.add('resources')
+        if not parse_delay:
+            disabled.add('delay')
+        if not parse_reloc:
+            disabled.add('reloc')
+        self._pending_dirs = set()
+        self._sections_pending = False
         of = 0
         self._sex = 0
         self._wsize = 32
@@ -395,23 +569,44 @@ class PE(object):
 
         self.Opthdr, l = Opthdr.unpack_l(self.content, of, self)
         self.NThdr = pe.NThdr.unpack(self.content, of + l, self)
-        self.img_rva[0] = self.content[:self.NThdr.sizeofheaders]
         of += self.Coffhdr.sizeofoptionalheader
         self.SHList = pe.SHList.unpack(self.content, of, self)
+        if self.loadfrommem:
+            for s in self.SHList.shlist:
+                s.offset = s.addr
+
+        self._sections_pending = True
+        if 'sections' in parse:
+            self.load_sections()
+
+        for item in ['imports', 'exports', 'delay', 'reloc', 'resources']:
+            name, cls, index = self.directories[item]
+            if len(self.NThdr.optentries) <= index:
+                continue
+            if item in disabled:
+                setattr(self, name, cls(self))
+            elif item in parse:
+                self.parse_directory(name)
+            else:
+                self._pending_dirs.add(name)
+
+    def load_sections(self):
+        """Load the data of the sections and map the image in img_rva;
+        done by parse_content if the parse profile has 'sections'"""
+        self._sections_pending = False
+        sizeofheaders = self.NThdr.sizeofheaders
+        img_layers = [(0, sizeofheaders,
+                       self.content.view(0, sizeofheaders))]
 
         # load section data
         filealignment = self.NThdr.filealignment
         for s in self.SHList.shlist:
-            if self.loadfrommem:
-                s.offset = s.addr
             if self.NThdr.sectionalignment > 0x1000:
                 raw_off = 0x200 * (s.offset / 0x200)
             else:
                 raw_off = s.offset
             if raw_off != s.offset:
                 log.warn('unaligned raw section (%x %x)!', raw_off, s.offset)
-            s.data = StrPatchwork()
-
             if s.rawsize == 0:
                 mm = 0
             else:
@@ -422,64 +617,30 @@ class PE(object):
                 mm = rs
             if mm > s.size:
                 mm = min(mm, s.size)
-            data = self.content[raw_off:raw_off + mm]
-            s.data[0] = data
+            s.data = self.content.view(raw_off, raw_off + mm)
             # Pad data to page size 0x1000
-            length = len(data)
-            data += "\x00" * ((((length + 0xfff)) & 0xFFFFF000) - length)
-            self.img_rva[s.addr] = data
-        # Fix img_rva
-        self.img_rva = str(self.img_rva)
-
-        try:
-            self.DirImport = pe.DirImport.unpack(self.img_rva,
-                                                 self.NThdr.optentries[
-                                                     pe.DIRECTORY_ENTRY_IMPORT].rva,
-                                                 self)
-        except pe.InvalidOffset:
-            log.warning('cannot parse DirImport, skipping')
-            self.DirImport = pe.DirImport(self)
-
+            length = len(s.data)
+            img_layers.append((s.addr, (length + 0xfff) & 0xFFFFF000, s.data))
+        # Mapped image, read from the sections data on demand
+        self.img_rva = LayeredView(img_layers)
+
+    def parse_directory(self, name):
+        """Parse the directory attribute @name (DirImport, DirExport,
+        DirDelay, DirReloc or DirRes) from the mapped image"""
+        self._pending_dirs.discard(name)
+        for attr, cls, index in self.directories.values():
+            if attr == name:
+                break
+        else:
+            raise ValueError('unknown directory %r' % name)
         try:
-            self.DirExport = pe.DirExport.unpack(self.img_rva,
-                                                 self.NThdr.optentries[
-                                                     pe.DIRECTORY_ENTRY_EXPORT].rva,
-                                                 self)
+            directory = cls.unpack(self.img_rva,
+                                   self.NThdr.optentries[index].rva, self)
         except pe.InvalidOffset:
-            log.warning('cannot parse DirExport, skipping')
-            self.DirExport = pe.DirExport(self)
-
-        if len(self.NThdr.optentries) > pe.DIRECTORY_ENTRY_DELAY_IMPORT:
-            self.DirDelay = pe.DirDelay(self)
-            if parse_delay:
-                try:
-                    self.DirDelay = pe.DirDelay.unpack(self.img_rva,
-                                                       self.NThdr.optentries[
-                                                           pe.DIRECTORY_ENTRY_DELAY_IMPORT].rva,
-                                                       self)
-                except pe.InvalidOffset:
-                    log.warning('cannot parse DirDelay, skipping')
-        if len(self.NThdr.optentries) > pe.DIRECTORY_ENTRY_BASERELOC:
-            self.DirReloc = pe.DirReloc(self)
-            if parse_reloc:
-                try:
-                    self.DirReloc = pe.DirReloc.unpack(self.img_rva,
-                                                       self.NThdr.optentries[
-                                                           pe.DIRECTORY_ENTRY_BASERELOC].rva,
-                                                       self)
-                except pe.InvalidOffset:
-                    log.warning('cannot parse DirReloc, skipping')
-        if len(self.NThdr.optentries) > pe.DIRECTORY_ENTRY_RESOURCE:
-            self.DirRes = pe.DirRes(self)
-            if parse_resources:
-                self.DirRes = pe.DirRes(self)
-                try:
-                    self.DirRes = pe.DirRes.unpack(self.img_rva,
-                                                   self.NThdr.optentries[
-                                                       pe.DIRECTORY_ENTRY_RESOURCE].rva,
-                                                   self)
-                except pe.InvalidOffset:
-                    log.warning('cannot parse DirRes, skipping')
+            log.warning('cannot parse %s, skipping', name)
+            directory = cls(self)
+        setattr(self, name, directory)
+        return directory
 
     def resize(self, old, new):
         pass
@@ -491,18 +652,42 @@ class PE(object):
         self.content.__setitem__(item, data)
         return
 
+    def patch_content(self, off, data):
+        """Write @data at @off in the file content, if any, in place"""
+        content = self.content
+        if not content or not data:
+            return
+        if isinstance(content, StrPatchwork):
+            content[off] = data
+        else:
+            self.content = content[:off] + data + content[off + len(data):]
+
+    def invalidate_section_index(self):
+        """Drop the section indexes; they are rebuilt on the next lookup"""
+        self._section_index = None
+
+    def get_section_index(self):
+        """Return the (rva, offset, virtual) AddrIndex of the sections,
+        rebuilt if SHList or its list of sections changed"""
+        shlist = self.SHList.shlist
+        index = self._section_index
+        if (index is None or index[0] is not self.SHList or
+                index[1] is not shlist or index[2] != len(shlist)):
+            # TODO CHECK: some binaries have import rva outside section,
+            # but addresses seems to be rounded
+            by_rva = AddrIndex([(s.addr,
+                                 ((s.addr + s.size + 0xfff) & 0xFFFFF000) -
+                                 s.addr, s) for s in shlist])
+            by_off = AddrIndex([(s.offset, s.rawsize, s) for s in shlist])
+            by_virt = AddrIndex([(s.addr, s.size, s) for s in shlist])
+            index = (self.SHList, shlist, len(shlist), by_rva, by_off, by_virt)
+            self._section_index = index
+        return index[3:]
+
     def getsectionbyrva(self, rva):
         if self.SHList is None:
             return None
-        for s in self.SHList.shlist:
-            """
-            TODO CHECK:
-            some binaries have import rva outside section, but addresses
-            seems to be rounded
-            """
-            if s.addr <= rva < (s.addr + s.size + 0xfff) & 0xFFFFF000:
-                return s
-        return None
+        return self.get_section_index()[0].find(rva)
 
     def getsectionbyvad(self, vad):
         return self.getsectionbyrva(self.virt2rva(vad))
@@ -510,10 +695,7 @@ class PE(object):
     def getsectionbyoff(self, off):
         if self.SHList is None:
             return None
-        for s in self.SHList.shlist:
-            if s.offset <= off < s.offset + s.rawsize:
-                return s
-        return None
+        return self.get_section_index()[1].find(off)
 
     def getsectionbyname(self, name):
         if self.SHList is None:
@@ -543,6 +725,36 @@ class PE(object):
             return
         return off - s.offset + s.addr
 
+    def rva2off_many(self, rvas):
+        """Same as rva2off for each of @rvas, with one pass over the
+        sections"""
+        rvas = list(rvas)
+        if self.SHList is None:
+            sections = [None] * len(rvas)
+        else:
+            sections = self.get_section_index()[0].find_many(rvas)
+        sizeofheaders = self.NThdr.sizeofheaders
+        falign = self.NThdr.filealignment
+        out = []
+        for rva, s in zip(rvas, sections):
+            if rva < sizeofheaders:
+                out.append(rva)
+            elif s is None:
+                raise pe.InvalidOffset('cannot get offset for 0x%X' % rva)
+            else:
+                out.append(rva - s.addr + (s.offset / falign) * falign)
+        return out
+
+    def off2rva_many(self, offs):
+        """Same as off2rva for each of @offs, with one pass over the
+        sections"""
+        offs = list(offs)
+        if self.SHList is None:
+            return [None] * len(offs)
+        sections = self.get_section_index()[1].find_many(offs)
+        return [None if s is None else off - s.offset + s.addr
+                for off, s in zip(offs, sections)]
+
     def virt2rva(self, virt):
         if virt == None:
             return
@@ -563,10 +775,7 @@ class PE(object):
         if ad < self.NThdr.ImageBase:
             return False
         ad = self.virt2rva(ad)
-        for s in self.SHList.shlist:
-            if s.addr <= ad < s.addr + s.size:
-                return True
-        return False
+        return self.get_section_index()[2].find(ad) is not None
 
     def get_drva(self):
         print 'Deprecated: Use PE.rva instead of PE.drva'
@@ -585,34 +794,22 @@ class PE(object):
     virt = property(get_virt)
 
     def patch_crc(self, c, olds):
-        s = 0L
-        data = c[:]
-        l = len(data)
-        if len(c) % 2:
-            end = struct.unpack('B', data[-1])[0]
-            data = data[:-1]
-        if (len(c) & ~0x1) % 4:
-            s += struct.unpack('H', data[:2])[0]
-            data = data[2:]
-        data = array.array('I', data)
-        s = reduce(lambda x, y: x + y, data, s)
-        s -= olds
-        while s > 0xFFFFFFFF:
-            s = (s >> 32) + (s & 0xFFFFFFFF)
-        while s > 0xFFFF:
-            s = (s & 0xFFFF) + ((s >> 16) & 0xFFFF)
-        if len(c) % 2:
-            s += end
-        s += l
-        return s
-
-    def build_content(self):
-
-        c = StrPatchwork()
+        """Return the checksum of the image @c, whose header holds the
+        checksum @olds"""
+        return pe_checksum(c, olds)
+
+    def build_layers(self):
+        """Lay out the file content: return the (offset, size, data) writes
+        of the headers, the sections data and the directories, the later
+        ones hiding the previous ones; the checksum is not patched"""
+        c = ContentLayers()
         c[0] = str(self.Doshdr)
 
         for s in self.SHList.shlist:
-            c[s.offset:s.offset + s.rawsize] = str(s.data)
+            data = s.data
+            if not isinstance(data, (str, StrPatchwork)):
+                data = str(data)
+            c[s.offset] = data
 
         # fix image size
         s_last = self.SHList.shlist[-1]
@@ -636,31 +833,106 @@ class PE(object):
             self.Coffhdr.sizeofoptionalheader
         c[off] = str(self.SHList)
 
+        # SHList.__len__ is the number of sections
+        shlist_end = off + self.SHList.packed_size()
         for s in self.SHList:
-            if off + len(str(self.SHList)) > s.offset:
+            if shlist_end > s.offset:
                 log.warn("section offset overlap pe hdr 0x%x 0x%x" %
-                         (off + len(str(self.SHList)), s.offset))
+                         (shlist_end, s.offset))
         self.DirImport.build_content(c)
         self.DirExport.build_content(c)
         self.DirDelay.build_content(c)
         self.DirReloc.build_content(c)
         self.DirRes.build_content(c)
-        s = str(c)
-        if (self.Doshdr.lfanew + len(self.NTsig) + len(self.Coffhdr)) % 4:
+        return c.layers
+
+    def layers_changes(self, layers):
+        """
+        Return the (start, stop) ranges of the file content which may
+        differ between the previous build_layers and @layers, None if
+        unknown; a StrPatchwork kept since then only changes on its
+        written extents
+        """
+        state = [(off, size, data, getattr(data, 'base', None), len(data))
+                 for off, size, data in layers]
+        previous = getattr(self, '_layers_state', None)
+        self._layers_state = state
+        if previous is None or len(previous) != len(state):
+            return None
+        changes = []
+        for new, old in zip(state, previous):
+            off, size, data, base, length = new
+            if new[:2] == old[:2] and length == old[4]:
+                if data is old[2] and base is not None and base is old[3]:
+                    for start, extent in zip(data.starts, data.extents):
+                        changes.append((off + start,
+                                        off + min(start + len(extent), size)))
+                    continue
+                if isinstance(data, str) and data == old[2]:
+                    continue
+            changes.append((off, off + size))
+            changes.append((old[0], old[0] + old[1]))
+        return changes
+
+    def write(self, f, chunk=0x100000):
+        """
+        Write the file content to the file object @f, @chunk bytes at a
+        time, sections data being read on demand. The checksum sums of the
+        chunks are kept between writes, only the chunks changed since the
+        previous one being summed again: on the fly, the checksum being
+        patched at the end, if @f is seekable, else by a first pass.
+        """
+        image = LayeredView(self.build_layers())
+        changes = self.layers_changes(image.layers)
+        crc_off = self.Doshdr.lfanew + len(self.NTsig) + len(self.Coffhdr)
+        if crc_off % 4:
             log.warn("non aligned coffhdr, bad crc calculation")
-        crcs = self.patch_crc(s, self.NThdr.CheckSum)
-        c[self.Doshdr.lfanew + len(self.NTsig) + len(
-            self.Coffhdr) + 64] = struct.pack('I', crcs)
-        return str(c)
+        crc_off += 64
+        crc = getattr(self, '_checksum', None)
+        if crc is None or crc.chunk != chunk:
+            crc = self._checksum = Checksum(chunk)
+            changes = None
+        crc.reset(len(image), changes)
+        try:
+            start = f.tell()
+        except (AttributeError, IOError):
+            start = None
+        if start is None:
+            image = LayeredView([(0, len(image), image),
+                                 (crc_off, 4, struct.pack(
+                                     'I', crc.update(image,
+                                                     self.NThdr.CheckSum)))])
+        for pos, end in crc.pieces():
+            data = image.read(pos, end)
+            crc.feed(pos, data)
+            f.write(data)
+        if start is not None:
+            end = f.tell()
+            f.seek(start + crc_off)
+            f.write(struct.pack('I', crc.update(image, self.NThdr.CheckSum)))
+            f.seek(end)
+
+    def build_content(self):
+        out = StringIO()
+        self.write(out)
+        return out.getvalue()
 
     def __str__(self):
         return self.build_content()
 
     def export_funcs(self):
+        """Return {name or ordinal: virtual address} of the named exports,
+        a copy of a dict cached until the exports or the image base
+        change"""
         if self.DirExport is None:
             print 'no export dir found'
             return None, None
 
+        by_name = self.DirExport.get_index()[0]
+        cached = getattr(self, '_export_funcs', None)
+        if (cached is not None and cached[0] is by_name and
+                cached[1] == self.NThdr.ImageBase):
+            return dict(cached[2])
         all_func = {}
         for i, n in enumerate(self.DirExport.f_names):
             all_func[n.name.name] = self.rva2virt(
@@ -668,24 +940,48 @@ class PE(object):
             all_func[self.DirExport.f_nameordinals[i].ordinal + self.DirExport.expdesc.base] = self.rva2virt(
                 self.DirExport.f_address[self.DirExport.f_nameordinals[i].ordinal].rva)
         # XXX todo: test if redirected export
-        return all_func
+        self._export_funcs = (by_name, self.NThdr.ImageBase, all_func)
+        return dict(all_func)
 
     def reloc_to(self, imgbase):
+        """Rebase the image to @imgbase, applying the relocations section
+        by section"""
         offset = imgbase - self.NThdr.ImageBase
         if self.DirReloc is None:
             log.warn('no relocation found!')
-        for rel in self.DirReloc.reldesc:
-            rva = rel.rva
-            for reloc in rel.rels:
-                t, off = reloc.rel
-                if t == 0 and off == 0:
-                    continue
-                if t != 3:
-                    raise ValueError('reloc type not impl')
-                off += rva
-                v = struct.unpack('I', self.rva.get(off, off + 4))[0]
-                v += offset
-                self.rva.set(off, struct.pack('I', v & 0xFFFFFFFF))
+            return
+        fixups = self.DirReloc.fixups()
+        for rva, t in fixups:
+            if t not in reloc_types:
+                raise ValueError('reloc type not impl')
+        sections = [None] * len(fixups)
+        if self.SHList is not None:
+            sections = self.get_section_index()[0].find_many(
+                [rva for rva, t in fixups])
+        by_section = {}
+        for (rva, t), s in zip(fixups, sections):
+            by_section.setdefault(s, []).append((rva, t))
+        for s, s_fixups in by_section.items():
+            if s is None:
+                # out of the sections
+                for rva, t in s_fixups:
+                    width, shift = reloc_types[t]
+                    buf = bytearray(self.rva.get(rva, rva + width))
+                    apply_relocs(buf, [(0, t)], offset)
+                    self.rva.set(rva, str(buf))
+                continue
+            s_fixups = [(rva - s.addr, t) for rva, t in s_fixups]
+            size = max(len(s.data),
+                       max(off + reloc_types[t][0] for off, t in s_fixups))
+            buf = bytearray(get_bytes(s.data, 0, size))
+            buf.extend("\x00" * (size - len(buf)))
+            apply_relocs(buf, s_fixups, offset)
+            data = str(buf)
+            if isinstance(s.data, StrPatchwork):
+                s.data[0:size] = data
+            else:
+                s.data = StrPatchwork(data)
+            self.patch_content(self.rva2off(s.addr), data[:s.rawsize])
         self.NThdr.ImageBase = imgbase
 
 
@@ -0,0 +1,268 @@
+import struct
+from strpatchwork import LayeredView, get_bytes
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def parse_signature(sig):
+    """Convert the signature @sig, e.g. "E8 ?? ?? ?? ?? 5?", into a
+    (str, mask) pattern; '?' is a wildcard nibble"""
+    data, mask = [], []
+    for byte in sig.split():
+        if len(byte) != 2:
+            raise ValueError('bad signature byte %r' % byte)
+        value = m = 0
+        for nibble in byte:
+            value <<= 4
+            m <<= 4
+            if nibble != '?':
+                value |= int(nibble, 16)
+                m |= 0xF
+        data.append(chr(value))
+        mask.append(chr(m))
+    return "".join(data), "".join(mask)
+
+
+def contiguous_runs(regions):
+    """Group the (address, size, data) @regions into runs of contiguous
+    memory; returns (address, LayeredView) pairs, data being zero filled
+    up to size"""
+    runs = []
+    for ad, size, data in sorted(regions, key=lambda r: r[0]):
+        if size <= 0:
+            continue
+        if runs and ad <= runs[-1][1]:
+            run = runs[-1]
+            run[1] = max(run[1], ad + size)
+        else:
+            run = [ad, ad + size, []]
+            runs.append(run)
+        run[2].append((ad - run[0], size, data))
+    return [(start, LayeredView(layers)) for start, stop, layers in runs]
+
+
+class Scanner(object):
+    """
+    Set of byte patterns, compiled once and run over any number of images.
+    @patterns: sequence or dict of patterns, hits being reported with the
+    index or the key of the pattern; a pattern is a str or a (str, mask)
+    pair, the bits set in mask being compared (see parse_signature)
+    The longest run of fully fixed bytes of each pattern is its anchor,
+    the other bytes are checked on each match of the anchor. Anchors are
+    matched by an Aho-Corasick automaton or, with numpy, by looking up
+    their last 8 bytes at every offset.
+    """
+
+    def __init__(self, patterns):
+        if isinstance(patterns, dict):
+            patterns = sorted(patterns.items())
+        else:
+            patterns = enumerate(patterns)
+        # (id, length, anchor stop, checks, checks without automaton) per
+        # pattern, a check being (index, mask, value)
+        self.patterns = []
+        goto, outputs = [{}], [[]]
+        keys = {}
+        for pid, pattern in patterns:
+            if isinstance(pattern, tuple):
+                data, mask = pattern
+                if len(mask) != len(data):
+                    raise ValueError('mask of pattern %r: bad length' % pid)
+            else:
+                data, mask = pattern, '\xff' * len(pattern)
+            anchor, cur = (0, 0), 0
+            for i, m in enumerate(mask + '\x00'):
+                if m != '\xff':
+                    if i - cur > anchor[1] - anchor[0]:
+                        anchor = (cur, i)
+                    cur = i + 1
+            a, b = anchor
+            if a == b:
+                raise ValueError('pattern %r has no fixed byte' % pid)
+            checks = [(i, ord(mask[i]), ord(data[i]) & ord(mask[i]))
+                      for i in xrange(len(data))
+                      if mask[i] != '\x00' and not a <= i < b]
+            k = min(b - a, 8)
+            key_checks = [(i, 0xFF, ord(data[i])) for i in xrange(a, b - k)]
+            self.patterns.append((pid, len(data), b, checks,
+                                  checks + key_checks))
+            idx = len(self.patterns) - 1
+            key = struct.unpack('<Q', data[b - k:b].ljust(8, '\x00'))[0]
+            keys.setdefault(k, {}).setdefault(key, []).append(idx)
+            state = 0
+            for c in bytearray(data[a:b]):
+                if c not in goto[state]:
+                    goto[state][c] = len(goto)
+                    goto.append({})
+                    outputs.append([])
+                state = goto[state][c]
+            outputs[state].append(idx)
+
+        # transitions of the root, then of each state where they differ
+        # from the root ones, filled breadth first along the failure links
+        self.root_next = [goto[0].get(c, 0) for c in xrange(256)]
+        self.delta = [{} for _ in goto]
+        self.out = [()] * len(goto)
+        fail = [0] * len(goto)
+        todo = goto[0].values()
+        for state in todo:
+            self.out[state] = tuple(outputs[state])
+        while todo:
+            next_todo = []
+            for state in todo:
+                delta = self.delta[state] = dict(self.delta[fail[state]])
+                delta.update(goto[state])
+                for c, child in goto[state].iteritems():
+                    f = self.delta[fail[state]].get(c, self.root_next[c])
+                    fail[child] = f
+                    self.out[child] = tuple(outputs[child]) + self.out[f]
+                    next_todo.append(child)
+            todo = next_todo
+
+        # (length, sorted keys, patterns per key) of the anchor keys
+        self.keys = []
+        for k, owners in sorted(keys.items()):
+            values = sorted(owners)
+            self.keys.append((k, values, [owners[v] for v in values]))
+        self._key_tables = None
+
+    def automaton_ends(self, buf, pos, state):
+        """Run the automaton from @state over @buf, a bytearray at offset
+        @pos; return the (anchor stop, pattern) list and the final state"""
+        delta, root_next, out = self.delta, self.root_next, self.out
+        ends = []
+        for i, c in enumerate(buf):
+            state = delta[state].get(c, root_next[c])
+            if out[state]:
+                ends.extend((pos + i + 1, k) for k in out[state])
+        return ends, state
+
+    def key_ends(self, buf, pos, first):
+        """Return the (anchor stop, pattern) list of the anchor keys in
+        @buf, a bytearray at offset @pos, which stop after @first"""
+        if self._key_tables is None:
+            # first 16 bits of the keys, to select candidates quickly
+            self._key_tables = []
+            for k, values, owners in self.keys:
+                values = numpy.array(values, numpy.uint64)
+                table = numpy.zeros(0x10000, bool)
+                table[values & numpy.uint64(0xFFFF)] = True
+                self._key_tables.append((k, values, table, owners))
+        a = numpy.frombuffer(buf, numpy.uint8)
+        ends = []
+        for k, values, table, owners in self._key_tables:
+            n = len(a) - k + 1
+            if n <= 0:
+                continue
+            v = a[:n].astype(numpy.uint64)
+            for j in xrange(1, k):
+                v |= a[j:n + j].astype(numpy.uint64) << numpy.uint64(8 * j)
+            cand = numpy.nonzero(table[v & numpy.uint64(0xFFFF)])[0]
+            v = v[cand]
+            i = numpy.searchsorted(values, v)
+            i[i == len(values)] = 0
+            found = values[i] == v
+            for off, key in zip(cand[found].tolist(), i[found].tolist()):
+                stop = pos + off + k
+                if stop > first:
+                    ends.extend((stop, idx) for idx in owners[key])
+        return ends
+
+    def scan(self, runs, chunk=0x100000):
+        """
+        Return the (address, pattern id) hits in @runs, sorted by address
+        @runs: (address, data) pairs of contiguous memory, data being a str,
+        a buffer object, a StrPatchwork or a LayeredView; matches may span
+        the chunks of @chunk bytes read from data
+        """
+        patterns = self.patterns
+        hits = []
+        for ad, data in runs:
+            length = len(data)
+            state = 0
+            for pos in xrange(0, length, chunk):
+                stop = min(pos + chunk, length)
+                if numpy is not None:
+                    # keys may start in the previous chunk
+                    first = pos
+                    pos -= min(pos, 7)
+                    buf = bytearray(get_bytes(data, pos, stop))
+                    ends = self.key_ends(buf, pos, first)
+                else:
+                    buf = bytearray(get_bytes(data, pos, stop))
+                    ends, state = self.automaton_ends(buf, pos, state)
+                for end, k in ends:
+                    pid, size, b, checks, key_checks = patterns[k]
+                    if numpy is not None:
+                        checks = key_checks
+                    start = end - b
+                    if start < 0 or start + size > length:
+                        continue
+                    if pos <= start and start + size <= stop:
+                        window, shift = buf, start - pos
+                    else:
+                        window = bytearray(get_bytes(data, start,
+                                                     start + size))
+                        shift = 0
+                    for j, m, v in checks:
+                        if window[shift + j] & m != v:
+                            break
+                    else:
+                        hits.append((ad + start, k))
+        hits.sort()
+        return [(ad, patterns[k][0]) for ad, k in hits]
+
+if __name__ == "__main__":
+    import random
+
+    def brute_force(patterns, runs):
+        hits = []
+        for ad, data in runs:
+            data = str(data)
+            for pid, (pattern, mask) in patterns:
+                for off in xrange(len(data) - len(pattern) + 1):
+                    for i in xrange(len(pattern)):
+                        if (ord(data[off + i]) & ord(mask[i]) !=
+                                ord(pattern[i]) & ord(mask[i])):
+                            break
+                    else:
+                        hits.append((ad + off, pid))
+        hits.sort()
+        return hits
+
+    rand = random.Random(0)
+    # a small alphabet, so that patterns and their prefixes occur often
+    alphabet = "\x00\x01\x55\xe8\xff"
+    signatures = ["E8 ?? ?? ?? ?? 55", "55 ?? 01", "00 00 00",
+                  "E8 00 01 55 FF 00 00 01 55", "5? 01 ?5 E8",
+                  "FF FF FF FF FF FF FF FF FF FF", "01"]
+    patterns = [parse_signature(sig) for sig in signatures]
+    patterns.append("\x55\x55\x00\xe8\x01\x01\x55\x00")
+    patterns.append(("\xe8\x55\x00", "\xff\xff\x00"))
+    for with_numpy in [numpy is not None, False]:
+        if not with_numpy:
+            numpy = None
+        for keyed in [False, True]:
+            if keyed:
+                scanner = Scanner(dict(enumerate(patterns)))
+            else:
+                scanner = Scanner(patterns)
+            expected_patterns = [(i, p if isinstance(p, tuple) else
+                                  (p, "\xff" * len(p)))
+                                 for i, p in enumerate(patterns)]
+            for chunk in [1, 7, 16, 100, 0x100000]:
+                # overlapping and adjacent regions, partly zero filled
+                regions = [(0x1000, 300, "".join(rand.choice(alphabet)
+                                                 for _ in xrange(250))),
+                           (0x1100, 40, "\xe8\x00\x01\x55\xff" * 8),
+                           (0x112c, 60, "\xff" * 60),
+                           (0xffffffff00000000, 200,
+                            "".join(rand.choice(alphabet)
+                                    for _ in xrange(200)))]
+                runs = contiguous_runs(regions)
+                assert len(runs) == 2
+                got = scanner.scan(runs, chunk)
+                assert got == brute_force(expected_patterns, runs), chunk
+    print "ok"
@@ -1,69 +1,541 @@
+import mmap as mmap_module
+import re
 from array import array
+from bisect import bisect_left, bisect_right
+from mmap import mmap
 from sys import maxint
 
+from intervals import AddrIndex
+
+# objects struct can decode in place
+buffer_types = (str, bytearray, buffer, memoryview, mmap, array)
+
+
+def get_bytes(s, start, stop):
+    """Return s[@start:@stop] as a str, @s being a str, a buffer object or a
+    StrPatchwork"""
+    v = s[start:stop]
+    if isinstance(v, memoryview):
+        return v.tobytes()
+    if isinstance(v, array):
+        return v.tostring()
+    return str(v)
+
+
+def unpack_from(st, s, off=0):
+    """Decode the struct.Struct @st at @off in @s, without intermediate
+    slice if @s is a buffer object or a StrPatchwork"""
+    if isinstance(s, buffer_types):
+        return st.unpack_from(s, off)
+    if isinstance(s, (StrPatchwork, LayeredView)):
+        return s.unpack_from(st, off)
+    return st.unpack(s[off:off + st.size])
+
+
+def find_bytes(s, pattern, off=0, end=None, chunk=0x1000):
+    """Return the offset of @pattern in s[@off:@end], or -1; @s may be a
+    buffer object without a find method"""
+    if end is None:
+        end = len(s)
+    if hasattr(s, 'find'):
+        return s.find(pattern, off, end)
+    while off < end:
+        data = get_bytes(s, off, min(off + chunk + len(pattern) - 1, end))
+        i = data.find(pattern)
+        if i != -1:
+            return off + i
+        off += chunk
+    return -1
+
+
+def is_readonly_buffer(s):
+    """True if @s can be kept by a StrPatchwork until its first
+    modification"""
+    if isinstance(s, memoryview):
+        return s.readonly
+    return isinstance(s, (mmap, buffer))
+
+
+def get_view(s, start, stop):
+    """Return s[@start:@stop] without copy if @s is a read only buffer"""
+    if isinstance(s, memoryview):
+        return s[start:stop]
+    if isinstance(s, (mmap, buffer)):
+        return buffer(s, start, max(stop - start, 0))
+    return s[start:stop]
+
+
+def read_file(path, mmap=True):
+    """Return the content of the file @path, memory mapped if @mmap (see
+    map_file)"""
+    if mmap:
+        return map_file(path)
+    f = open(path, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def map_file(path):
+    """Return a read only memory map of the file @path; truncating or
+    overwriting the file while the map is in use makes reads fail with
+    SIGBUS, write the output to another path"""
+    f = open(path, 'rb')
+    try:
+        f.seek(0, 2)
+        if not f.tell():
+            # empty files cannot be mapped
+            return ""
+        return mmap(f.fileno(), 0, access=mmap_module.ACCESS_READ)
+    finally:
+        f.close()
+
 
 class StrPatchwork:
+    """
+    Mutable string, padded with paddingbyte when written or read past its
+    end.
+    The content is an immutable base (str or read only buffer, which is
+    never copied) overlaid with sorted extents of written data; gaps past
+    the base are virtual padding. The extents are only flattened when the
+    whole string is needed. writes counts the changes, so that caches
+    built on the content can tell they are stale.
+    """
 
     def __init__(self, s="", paddingbyte="\x00"):
-        self.s = array("B", str(s))
-        # cache s to avoid rebuilding str after each find
-        self.s_cache = s
+        if not (isinstance(s, str) or is_readonly_buffer(s)):
+            if isinstance(s, buffer_types):
+                s = get_bytes(s, 0, len(s))
+            else:
+                s = str(s)
+        self.base = s
         self.paddingbyte = paddingbyte
+        # start offsets and data (bytearray) of the written extents
+        self.starts = []
+        self.extents = []
+        self.length = len(s)
+        self.writes = 0
 
-    def __str__(self):
-        return self.s.tostring()
+    def segments(self, start=0):
+        """
+        Yield the (start, stop, data) segments covering the string from
+        @start; data is an extent, the base, or None for padding
+        """
+        starts, extents = self.starts, self.extents
+        base_len = len(self.base)
+        i = bisect_right(starts, start) - 1
+        if i < 0 or starts[i] + len(extents[i]) <= start:
+            i += 1
+        pos = start
+        while pos < self.length:
+            if i < len(starts) and starts[i] <= pos:
+                end = starts[i] + len(extents[i])
+                yield starts[i], end, extents[i]
+                pos = end
+                i += 1
+                continue
+            if i < len(starts):
+                end = starts[i]
+            else:
+                end = self.length
+            if pos < base_len:
+                end = min(end, base_len)
+                yield pos, end, self.base
+            else:
+                yield pos, end, None
+            pos = end
 
-    def __getitem__(self, item):
-        s = self.s
-        if type(item) is slice:
-            end = item.stop
-            l = len(s)
-            if l < end and end != maxint:  # XXX hack [x:] give 2GB limit
-                # This is inefficient but avoids complicated maths if step is
-                # not 1
-                s = s[:]
-                s.extend(array("B", self.paddingbyte * (end - l)))
-            r = s[item]
-            return r.tostring()
+    def read(self, start, stop):
+        """Return the content in [@start:@stop], padded past the end"""
+        if not self.extents and stop <= len(self.base):
+            return get_bytes(self.base, start, stop)
+        out = []
+        pos = start
+        for seg_start, seg_stop, data in self.segments(start):
+            if pos >= stop:
+                break
+            end = min(seg_stop, stop)
+            if data is None:
+                out.append(self.paddingbyte * (end - pos))
+            elif data is self.base:
+                out.append(get_bytes(data, pos, end))
+            else:
+                out.append(str(data[pos - seg_start:end - seg_start]))
+            pos = end
+        if pos < stop:
+            out.append(self.paddingbyte * (stop - pos))
+        return "".join(out)
 
+    def write(self, start, data):
+        """Write the str @data at @start"""
+        stop = start + len(data)
+        self.length = max(self.length, stop)
+        self.writes += 1
+        if not data:
+            return
+        starts, extents = self.starts, self.extents
+        # extents overlapping or adjacent to [start, stop]
+        first = bisect_right(starts, start) - 1
+        if first < 0 or starts[first] + len(extents[first]) < start:
+            first += 1
+        last = bisect_right(starts, stop)
+        if first == last:
+            starts.insert(first, start)
+            extents.insert(first, bytearray(data))
+            return
+        s0 = starts[first]
+        ext = extents[first]
+        if last - first == 1 and s0 <= start and stop <= s0 + len(ext):
+            ext[start - s0:stop - s0] = data
+            return
+        tail = extents[last - 1]
+        suffix = tail[stop - starts[last - 1]:]
+        if s0 < start:
+            del ext[start - s0:]
+            ext += data
         else:
-            if item > len(s):
+            s0 = start
+            ext = bytearray(data)
+        ext += suffix
+        starts[first:last] = [s0]
+        extents[first:last] = [ext]
+
+    def overlaps(self, start, stop):
+        """True if an extent overlaps [@start:@stop]"""
+        i = bisect_left(self.starts, stop) - 1
+        return i >= 0 and self.starts[i] + len(self.extents[i]) > start
+
+    def __str__(self):
+        if self.extents or len(self.base) < self.length:
+            # flatten once
+            self.base = self.read(0, self.length)
+            self.starts, self.extents = [], []
+        return get_bytes(self.base, 0, self.length)
+
+    def __getitem__(self, item):
+        if type(item) is not slice:
+            if item > self.length:
                 return self.paddingbyte
-            else:
-                return chr(s[item])
+            if item < 0:
+                item += self.length
+            if not 0 <= item < self.length:
+                raise IndexError('array index out of range')
+            return self.read(item, item + 1)
+        end = item.stop
+        l = self.length
+        if l < end and end != maxint:  # XXX hack [x:] give 2GB limit
+            l = end
+        start, stop, step = item.indices(l)
+        if step != 1:
+            return self.read(0, l)[item]
+        if stop <= start:
+            return ""
+        return self.read(start, stop)
 
     def __setitem__(self, item, val):
         if val == None:
             return
-        val = array("B", val)
+        if not isinstance(val, str):
+            if isinstance(val, buffer_types):
+                val = get_bytes(val, 0, len(val))
+            else:
+                val = array("B", val).tostring()
         if type(item) is not slice:
-            item = slice(item, item + len(val))
+            if item < 0:
+                item += self.length
+            self.write(item, val)
+            return
         end = item.stop
-        l = len(self.s)
+        if (item.step in (None, 1) and end is not None and
+                0 <= item.start <= end and end - item.start == len(val)):
+            self.write(item.start, val)
+            return
+        # resizing or extended slice assignment
+        s = array("B", str(self))
+        l = len(s)
         if l < end:
-            self.s.extend(array("B", self.paddingbyte * (end - l)))
-        self.s[item] = val
-        self.s_cache = None
+            s.extend(array("B", self.paddingbyte * (end - l)))
+        s[item] = array("B", val)
+        writes = self.writes
+        self.__init__(s.tostring(), self.paddingbyte)
+        self.writes = writes + 1
 
     def __repr__(self):
-        return "<Patchwork %r>" % self.s.tostring()
+        return "<Patchwork %r>" % str(self)
 
     def __len__(self):
-        return len(self.s)
+        return self.length
 
     def __contains__(self, val):
-        return val in str(self)
+        return self.find(val) != -1
 
     def __iadd__(self, other):
-        self.s.extend(array("B", other))
+        self[self.length] = other
         return self
 
-    def find(self, pattern, offset=0):
-        if not self.s_cache:
-            self.s_cache = self.s.tostring()
-        return self.s_cache.find(pattern, offset)
+    def unpack_from(self, st, off=0):
+        """Decode the struct.Struct @st at @off, padding past the end"""
+        end = off + st.size
+        if 0 <= off and end <= len(self.base) and not self.overlaps(off, end):
+            return st.unpack_from(self.base, off)
+        return st.unpack(self[off:end])
+
+    def view(self, start, stop):
+        """Return a StrPatchwork of self[@start:@stop], sharing the base
+        buffer if it is not overwritten there"""
+        if (0 <= start <= stop <= len(self.base) and
+                not self.overlaps(start, stop)):
+            return StrPatchwork(get_view(self.base, start, stop),
+                                self.paddingbyte)
+        return StrPatchwork(self[start:stop], self.paddingbyte)
+
+    def find_segment(self, pattern, start, stop, data, seg_start):
+        """Find @pattern in [@start:@stop], which lies in the segment @data
+        starting at @seg_start"""
+        if data is None:
+            if (pattern == self.paddingbyte * len(pattern) and
+                    stop - start >= len(pattern)):
+                return start
+            return -1
+        if data is self.base:
+            if not hasattr(data, 'find'):
+                i = get_bytes(data, start, stop).find(pattern)
+                return i if i == -1 else i + start
+            return data.find(pattern, start, stop)
+        i = data.find(pattern, start - seg_start, stop - seg_start)
+        return i if i == -1 else i + seg_start
+
+    def find(self, pattern, offset=0, end=None):
+        if offset < 0:
+            offset = max(offset + self.length, 0)
+        if end is None or end > self.length:
+            end = self.length
+        elif end < 0:
+            end = max(end + self.length, 0)
+        if not pattern:
+            return offset if offset <= end else -1
+        size = len(pattern)
+        for seg_start, seg_stop, data in self.segments(offset):
+            if seg_start >= end:
+                break
+            if size > 1 and seg_start > offset:
+                # occurrences across the previous segment boundary
+                of = max(offset, seg_start - size + 1)
+                i = self.read(of, min(seg_start + size - 1, end)).find(pattern)
+                if i != -1 and of + i < seg_start:
+                    return of + i
+            i = self.find_segment(pattern, max(seg_start, offset),
+                                  min(seg_stop, end), data, seg_start)
+            if i != -1:
+                return i
+        return -1
+
+    def iter_matches(self, regex, size, start=0, end=None):
+        """
+        Yield (offset, match) for each position in [@start:@end] where the
+        compiled @regex matches; @regex must be a lookahead of at most
+        @size bytes, so that overlapping occurrences are found
+        """
+        if end is None or end > self.length:
+            end = self.length
+        for seg_start, seg_stop, data in self.segments(start):
+            if seg_start >= end:
+                break
+            a = max(seg_start, start)
+            stop = min(seg_stop, end)
+            # matches starting before safe only need the segment data
+            safe = stop - size + 1
+            if a < safe and data is None:
+                m = regex.match(self.paddingbyte * size)
+                if m is not None:
+                    for p in xrange(a, safe):
+                        yield p, m
+            elif a < safe:
+                of = seg_start
+                if data is self.base:
+                    of = 0
+                    if isinstance(data, memoryview):
+                        data, of = get_bytes(data, a, stop), a
+                for m in regex.finditer(data, a - of, stop - of):
+                    if m.start() + of >= safe:
+                        break
+                    yield m.start() + of, m
+            # matches starting near the end of the segment
+            of = max(a, safe)
+            if of < stop:
+                window = self.read(of, min(stop + size - 1, end))
+                for m in regex.finditer(window):
+                    if of + m.start() >= stop:
+                        break
+                    yield of + m.start(), m
+
+    def find_all(self, pattern, start=0, end=None):
+        """Yield the offsets of all the (possibly overlapping) occurrences
+        of @pattern in [@start:@end]"""
+        if not pattern:
+            raise ValueError('empty pattern')
+        regex = re.compile('(?=%s)' % re.escape(pattern))
+        for off, m in self.iter_matches(regex, len(pattern), start, end):
+            yield off
+
+    def find_many(self, patterns, start=0, end=None):
+        """
+        Yield (offset, pattern) for all the occurrences of any of
+        @patterns in [@start:@end], by offset then longest pattern first
+        """
+        patterns = sorted(set(patterns), key=len, reverse=True)
+        if not patterns or not patterns[-1]:
+            raise ValueError('empty pattern')
+        regex = re.compile('(?=(%s))' % '|'.join(map(re.escape, patterns)))
+        # a match of a pattern is also a match of its prefixes
+        prefixes = dict((p, [q for q in patterns if p.startswith(q)])
+                        for p in patterns)
+        for off, m in self.iter_matches(regex, len(patterns[0]), start, end):
+            for p in prefixes[str(m.group(1))]:
+                yield off, p
 
     def rfind(self, pattern, start=0, end=None):
-        if not self.s_cache:
-            self.s_cache = self.s.tostring()
-        return self.s_cache.rfind(pattern, start, end)
+        if end is None:
+            end = self.length
+        if not self.extents and end <= len(self.base):
+            if hasattr(self.base, 'rfind'):
+                return self.base.rfind(pattern, start, end)
+        start, end, _ = slice(start, end).indices(self.length)
+        i = self.read(start, max(start, end)).rfind(pattern)
+        return i if i == -1 else i + start
+
+
+class LayeredView(object):
+    """
+    Read only string made of layers (start, size, data), each one hiding the
+    previous ones on [start:start+size]; data is a str, a buffer object or
+    a StrPatchwork, read on demand and padded with paddingbyte up to size.
+    Gaps between layers are padding too.
+    """
+
+    def __init__(self, layers, paddingbyte="\x00"):
+        self.layers = list(layers)
+        self.paddingbyte = paddingbyte
+        self.index = AddrIndex([(start, size, (start, data))
+                                for start, size, data in reversed(self.layers)])
+        self.length = max([start + size for start, size, data in self.layers
+                           if size > 0] or [0])
+        # last flat_range() used by unpack_from
+        self._flat = None
+
+    def read(self, start, stop):
+        """Return the content in [@start:@stop]"""
+        stop = min(stop, self.length)
+        bounds, items = self.index.bounds, self.index.items
+        k = bisect_right(bounds, start) - 1
+        out = []
+        pos = start
+        while pos < stop:
+            if 0 <= k < len(items):
+                item, end = items[k], min(bounds[k + 1], stop)
+            else:
+                item, end = None, stop if k >= 0 else min(bounds[0], stop)
+            if item is None:
+                out.append(self.paddingbyte * (end - pos))
+            else:
+                l_start, data = item
+                l_len = len(data)
+                a, b = pos - l_start, end - l_start
+                if a < l_len:
+                    out.append(get_bytes(data, a, min(b, l_len)))
+                if b > l_len:
+                    out.append(self.paddingbyte * (b - max(a, l_len)))
+            pos = end
+            k += 1
+        return "".join(out)
+
+    def flat_range(self, off):
+        """
+        Return (lo, hi, shift, buf, owner) such that [lo:hi], around @off,
+        is buf[lo - shift:hi - shift]; owner is the StrPatchwork whose base
+        is buf, if any. None if @off is not in the data of a layer.
+        """
+        bounds, items = self.index.bounds, self.index.items
+        k = bisect_right(bounds, off) - 1
+        if not (0 <= k < len(items)) or items[k] is None:
+            return None
+        l_start, data = items[k]
+        owner = None
+        if isinstance(data, StrPatchwork):
+            owner, data = data, data.base
+        if not isinstance(data, buffer_types):
+            return None
+        hi = min(bounds[k + 1], l_start + len(data))
+        return (bounds[k], hi, l_start, data, owner)
+
+    def unpack_from(self, st, off=0):
+        """Decode the struct.Struct @st at @off, in place if it lies in the
+        unmodified data of one layer"""
+        end = off + st.size
+        flat = self._flat
+        # the owner replaces its base when flattened
+        if (flat is None or not flat[0] <= off or flat[1] < end or
+                (flat[4] is not None and flat[4].base is not flat[3])):
+            flat = self._flat = self.flat_range(off)
+        if (flat is not None and flat[0] <= off and end <= flat[1] and
+                (flat[4] is None or not flat[4].extents)):
+            return st.unpack_from(flat[3], off - flat[2])
+        return st.unpack(self.read(off, end))
+
+    def view(self, start, stop):
+        """Return a StrPatchwork of self[@start:@stop], sharing the buffer
+        of the layer if it lies in its unmodified data"""
+        flat = self.flat_range(start)
+        if (flat is not None and start < stop <= flat[1] and
+                (flat[4] is None or
+                 not flat[4].overlaps(start - flat[2], stop - flat[2]))):
+            return StrPatchwork(get_view(flat[3], start - flat[2],
+                                         stop - flat[2]), self.paddingbyte)
+        return StrPatchwork(self[start:stop], self.paddingbyte)
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return self.read(0, self.length)
+
+    def __getitem__(self, item):
+        if type(item) is not slice:
+            if item < 0:
+                item += self.length
+            if not 0 <= item < self.length:
+                raise IndexError('string index out of range')
+            return self.read(item, item + 1)
+        start, stop, step = item.indices(self.length)
+        if step != 1:
+            return str(self)[item]
+        return self.read(start, stop)
+
+    def __repr__(self):
+        return "<%s length=%d layers=%d>" % (self.__class__.__name__,
+                                             self.length, len(self.layers))
+
+if __name__ == "__main__":
+    import struct
+
+    s = StrPatchwork("0123456789")
+    s[12] = "ab"
+    assert str(s) == "0123456789\x00\x00ab"
+    s[3] = "xyz"
+    assert s[2:7] == "2xyz6" and s.find("z6") == 5
+
+    # unpack_from in place, then after writes and after the owner
+    # flattened its base
+    st = struct.Struct("<I")
+    data = StrPatchwork("\x01\x00\x00\x00" * 4)
+    view = LayeredView([(0x100, 0x10, data), (0x200, 8, "\x02" * 8)])
+    assert view.unpack_from(st, 0x104) == (1,)
+    data[4] = "ABCD"
+    assert view.unpack_from(st, 0x104) == (0x44434241,)
+    str(data)
+    assert view.unpack_from(st, 0x104) == (0x44434241,)
+    assert view.unpack_from(st, 0x10c) == (1,)
+    assert view.unpack_from(st, 0x1fe) == (0x0202 << 16,)
+    assert view[0x104:0x108] == "ABCD"
+    print "ok"
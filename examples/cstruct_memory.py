@@ -0,0 +1,43 @@
+#! /usr/bin/env python
+"""Report the memory used per CStruct instance, with and without _compact"""
+import struct
+import sys
+import types
+from elfesteem.new_cstruct import CStruct
+from elfesteem import minidump, pe
+
+
+def instance_size(obj):
+    """Bytes used by @obj, including its __dict__ if any"""
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def dict_twin(cls):
+    """Return a non compact copy of the CStruct class @cls"""
+    dct = dict((k, v) for k, v in cls.__dict__.items()
+               if isinstance(v, types.FunctionType))
+    dct['_fields'] = cls._fields
+    dct['_compact'] = False
+    return type(cls)(cls.__name__ + "_dict", (CStruct,), dct)
+
+
+samples = [
+    (minidump.MemoryDescriptor64, struct.pack('<QQ', 0x10000, 0x1000)),
+    (minidump.Rva, struct.pack('<I', 0x1234)),
+    (pe.Reloc, struct.pack('<H', 0x3123)),
+]
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+for cls, raw in samples:
+    line = "%-20s" % cls.__name__
+    for klass in [dict_twin(cls), cls]:
+        obj = klass.unpack(raw)
+        line += " %6d" % instance_size(obj)
+    print line + " bytes/instance (dict, compact)"
+    if count:
+        objs = [cls.unpack(raw) for _ in xrange(count)]
+        print "  %d instances: %d bytes" % (
+            count, sum(instance_size(obj) for obj in objs))
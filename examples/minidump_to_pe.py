@@ -4,7 +4,7 @@ import sys
 from elfesteem.minidump_init import Minidump
 from elfesteem.pe_init import PE
 
-minidump = Minidump(open(sys.argv[1]).read())
+minidump = Minidump.from_file(sys.argv[1])
 
 pe = PE()
 for i, memory in enumerate(sorted(minidump.memory.itervalues(),